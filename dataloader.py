@@ -1,12 +1,496 @@
 import os
 import json
 import h5py
+import hashlib
+import threading
 import numpy as np
 import torch
+import torch.nn.functional as F
 from six import iteritems
 from six.moves import range
+from six.moves import queue
+from timeit import default_timer as timer
 from sklearn.preprocessing import normalize
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
+from torch.utils.data import get_worker_info
+
+
+class LazyH5Array(object):
+    def __init__(self, fileName, key):
+        '''
+            Read-only view of the HDF5 dataset 'key' in 'fileName' whose rows
+            are read from disk on indexing instead of being loaded up front.
+
+            Contiguous, uncompressed datasets are memory-mapped directly,
+            all others fall back to h5py (chunked) reads. Open handles are
+            dropped when pickled so views can be sent to DataLoader workers.
+        '''
+        self.fileName = fileName
+        self.key = key
+        with h5py.File(fileName, 'r') as fileId:
+            dataset = fileId[key]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            canMap = dataset.chunks is None and dataset.compression is None
+            self.offset = dataset.id.get_offset() if canMap else None
+        self._array = None
+
+    def _open(self):
+        if self._array is None:
+            if self.offset is not None:
+                self._array = np.memmap(self.fileName, mode='r',
+                                        dtype=self.dtype, shape=self.shape,
+                                        offset=self.offset)
+            else:
+                self._array = h5py.File(self.fileName, 'r')[self.key]
+        return self._array
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        return np.array(self._open()[idx])
+
+    def readAll(self):
+        '''
+            All rows, read through a short-lived handle so that no h5py
+            handle is cached in a process that later forks workers.
+        '''
+        with h5py.File(self.fileName, 'r') as fileId:
+            return fileId[self.key][()]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+def gatherOptions(batch, round):
+    '''
+    Return the (batchSize, numOptions, maxLen) option sequences of dialog
+    round 'round' from a collated batch. Batches hold either all options
+    ('opt') or, when the dataset pools options, indices ('opt_ind') into
+    the batch option pool ('opt_pool').
+    '''
+    if 'opt' in batch:
+        return batch['opt'][:, round]
+    return batch['opt_pool'][batch['opt_ind'][:, round]]
+
+
+def collateItems(batch):
+    '''
+    Merge data points (dicts returned by VisDialDataset.getIndexItem) into a
+    batch, trimming padded sequences to the longest one in the batch.
+    '''
+    out = {}
+
+    mergedBatch = {key: [d[key] for d in batch] for key in batch[0]}
+    for key in mergedBatch:
+        if key == 'img_fname' or key == 'index':
+            out[key] = mergedBatch[key]
+        elif key == 'cap_len':
+            # 'cap_lens' are single integers, need special treatment
+            out[key] = torch.LongTensor(mergedBatch[key])
+        else:
+            out[key] = torch.stack(mergedBatch[key], 0)
+            # Widen compactly stored integer tensors
+            if not out[key].is_floating_point() and key != 'img_feat':
+                out[key] = out[key].long()
+
+    # Restore reduced precision image features
+    if 'img_scale' in out:
+        scale = out.pop('img_scale')
+        out['img_feat'] = out['img_feat'].float() * scale.unsqueeze(1)
+    elif 'img_feat' in out:
+        out['img_feat'] = out['img_feat'].float()
+
+    # Dynamic shaping of padded batch
+    if 'ques' in out.keys():
+        quesLen = out['ques_len'] + 1
+        out['ques'] = out['ques'][:, :, :torch.max(quesLen)].contiguous()
+
+    if 'ans' in out.keys():
+        ansLen = out['ans_len'] + 1
+        out['ans'] = out['ans'][:, :, :torch.max(ansLen)].contiguous()
+
+    if 'cap' in out.keys():
+        capLen = out['cap_len'] + 1
+        out['cap'] = out['cap'][:, :torch.max(capLen)].contiguous()
+
+    if 'opt' in out.keys():
+        optLen = out['opt_len'] + 1
+        out['opt'] = out['opt'][:, :, :, :torch.max(optLen) + 2].contiguous()
+
+    return out
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, dataset, batchSize, poolBatches=50, shuffle=True,
+                 dropLast=False, seed=None):
+        '''
+            Batch sampler grouping dialogs of the current dataset split with
+            similar length profiles (longest question, longest answer and
+            caption length) into the same batch, which reduces the padding
+            fed to every packed RNN call.
+
+            Every epoch, dialogs are shuffled and split into pools of
+            'poolBatches' batches. Each pool is sorted by length profile
+            and cut into batches, and the order of all batches is shuffled.
+            The shuffle of epoch e (counted by iteration or set with
+            setEpoch) is seeded with 'seed' + e, so a resumed run replays
+            the batches of its epochs. If seed is None, every epoch draws
+            its seed from the global torch RNG, as DataLoader does with
+            shuffle=True.
+        '''
+        self.batchSize = batchSize
+        self.poolBatches = poolBatches
+        self.shuffle = shuffle
+        self.dropLast = dropLast
+        self.seed = seed
+        self.epoch = 0
+        self.numRounds = dataset.numRounds
+        # Columns are caption, question and answer lengths
+        self.lengths = dataset.getLengthProfile(dataset.split)
+
+    def setEpoch(self, epoch):
+        '''Set the epoch seeding the batches of the next iteration'''
+        self.epoch = epoch
+
+    def summary(self):
+        '''Padding of bucketed vs uniformly random batches for one epoch'''
+        generator = torch.Generator()
+        generator.manual_seed(self.seed or 0)
+        numDialogs = len(self.lengths)
+        order = torch.randperm(numDialogs, generator=generator)
+        randomTokens = self.paddedTokens(order.split(self.batchSize))
+        bucketTokens = self.paddedTokens(self.makeBatches(generator))
+        realTokens = self.lengths[:, 0].sum().item() + self.numRounds * \
+            self.lengths[:, 1:].sum().item()
+        return 'Bucketed batches: %d padded tokens per epoch (%.1f%% ' \
+               'padding) vs %d for random batches (%.1f%% padding)' % (
+                   bucketTokens, 100 * (1 - realTokens / float(bucketTokens)),
+                   randomTokens, 100 * (1 - realTokens / float(randomTokens)))
+
+    def paddedTokens(self, batches):
+        '''Number of tokens (including padding) in a list of batches'''
+        numTokens = 0
+        for batch in batches:
+            maxLens = self.lengths[batch].max(0)[0]
+            numTokens += len(batch) * (maxLens[0].item() + self.numRounds *
+                                       maxLens[1:].sum().item())
+        return numTokens
+
+    def makeBatches(self, generator):
+        numDialogs = len(self.lengths)
+        if self.shuffle:
+            order = torch.randperm(numDialogs, generator=generator)
+        else:
+            order = torch.arange(numDialogs)
+        if self.dropLast:
+            order = order[:numDialogs - numDialogs % self.batchSize]
+
+        # Sort each pool by (question, answer, caption) length
+        maxLen = self.lengths.max().item() + 1
+        sortKey = (self.lengths[:, 1] * maxLen + self.lengths[:, 2]) * \
+            maxLen + self.lengths[:, 0]
+        batches = []
+        poolSize = self.batchSize * self.poolBatches
+        for pool in order.split(poolSize):
+            _, poolOrder = torch.sort(sortKey[pool], stable=True)
+            batches.extend(pool[poolOrder].split(self.batchSize))
+
+        if self.shuffle:
+            batchOrder = torch.randperm(len(batches), generator=generator)
+            batches = [batches[batchId] for batchId in batchOrder.tolist()]
+        return batches
+
+    def __iter__(self):
+        generator = torch.Generator()
+        if self.seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            seed = self.seed + self.epoch
+        generator.manual_seed(seed)
+        self.epoch += 1
+        for batch in self.makeBatches(generator):
+            yield batch.tolist()
+
+    def __len__(self):
+        numDialogs = len(self.lengths)
+        if self.dropLast:
+            return numDialogs // self.batchSize
+        return (numDialogs + self.batchSize - 1) // self.batchSize
+
+
+class BlockShuffleSampler(Sampler):
+    def __init__(self, numDataPoints, blockSize, windowBlocks=4, seed=0,
+                 epoch=0, start=0):
+        '''
+            Sampler shuffling contiguous blocks of 'blockSize' data points
+            instead of single data points, so that lazily loaded or memory
+            mapped arrays are still read mostly sequentially.
+
+            Every epoch, the order of blocks is shuffled and the data points
+            within each window of 'windowBlocks' consecutive blocks are
+            shuffled again. The order only depends on 'seed' and the epoch,
+            and the first epoch starts at data point 'start' of its order,
+            which allows resuming training at any iteration.
+        '''
+        self.numDataPoints = numDataPoints
+        self.blockSize = blockSize
+        self.windowBlocks = windowBlocks
+        self.seed = seed
+        self.epoch = epoch
+        self.start = start
+
+    def epochOrder(self, epoch):
+        '''Order of data points for the given epoch'''
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        blocks = torch.arange(self.numDataPoints).split(self.blockSize)
+        blockOrder = torch.randperm(len(blocks), generator=generator)
+        order = torch.cat([blocks[blockId] for blockId in blockOrder.tolist()])
+        windows = order.split(self.blockSize * self.windowBlocks)
+        return torch.cat([window[torch.randperm(len(window),
+                                                generator=generator)]
+                          for window in windows])
+
+    def __iter__(self):
+        order = self.epochOrder(self.epoch)[self.start:]
+        self.epoch += 1
+        self.start = 0
+        return iter(order.tolist())
+
+    def __len__(self):
+        return self.numDataPoints - self.start
+
+
+class VisDialShards(IterableDataset):
+    def __init__(self, shardDir, split, shuffle=True, shuffleBuffer=1000,
+                 seed=0, batchSize=1):
+        '''
+            Stream the data points of split 'split' from the shards written
+            to 'shardDir' by VisDialDataset.writeShards, holding only one
+            memory-mapped shard and the shuffle buffer at a time.
+
+            Each shard directory holds one .npy file per data point key
+            (stacked along the first dimension) and a shard-local option
+            pool ('opt_pool', indexed by 'opt_ind'). '<split>.json' lists
+            the shards and the number of data points.
+
+            With 'shuffle', the shard order is shuffled every epoch and
+            data points pass through a buffer of 'shuffleBuffer' data
+            points, seeded from 'seed' and the epoch set by setEpoch.
+
+            DataLoader workers take turns on runs of 'batchSize' data points
+            of the epoch (the DataLoader batch size), so every worker forms
+            complete batches and only the last batch of the epoch can be
+            incomplete, as with a single process.
+        '''
+        self.shardDir = shardDir
+        self.split = split
+        self.shuffle = shuffle
+        self.shuffleBuffer = shuffleBuffer
+        self.seed = seed
+        self.batchSize = batchSize
+        self.epoch = 0
+        with open(self.manifestPath(shardDir, split), 'r') as fileId:
+            info = json.load(fileId)
+        self.shards = info['shards']
+        self.numDataPoints = info['numDataPoints']
+
+    @staticmethod
+    def manifestPath(shardDir, split):
+        return os.path.join(shardDir, split + '.json')
+
+    def setEpoch(self, epoch):
+        '''Set the epoch seeding the shard order and shuffle buffer'''
+        self.epoch = epoch
+
+    def shardLength(self, shard):
+        '''Number of data points in a shard'''
+        indexPath = os.path.join(self.shardDir, shard, 'index.npy')
+        return len(np.load(indexPath, mmap_mode='r'))
+
+    def readShard(self, shard, localIds=None):
+        '''
+        Yield the data points of a shard as VisDialDataset items, only
+        those at positions 'localIds' in the shard if given
+        '''
+        shardPath = os.path.join(self.shardDir, shard)
+        with open(os.path.join(shardPath, 'info.json'), 'r') as fileId:
+            info = json.load(fileId)
+        arrays = {
+            key: torch.from_numpy(
+                np.load(os.path.join(shardPath, key + '.npy'), mmap_mode='c'))
+            for key in info['keys']
+        }
+        optPool = arrays.pop('opt_pool', None)
+        optInds = arrays.pop('opt_ind', None)
+        indices = arrays.pop('index').tolist()
+        if localIds is None:
+            localIds = range(len(indices))
+        for localId in localIds:
+            item = {'index': indices[localId]}
+            # Copy out of the shard, so it is unmapped once read
+            for key, value in iteritems(arrays):
+                item[key] = value[localId].clone()
+            if optPool is not None:
+                inds = optInds[localId]
+                opts = optPool.index_select(0, inds.view(-1).long())
+                item['opt'] = opts.view(list(inds.size()) + [-1])
+            yield item
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        shards = self.shards
+        if self.shuffle:
+            shardOrder = torch.randperm(len(shards), generator=generator)
+            shards = [shards[shardId] for shardId in shardOrder.tolist()]
+
+        workerInfo = get_worker_info()
+        if workerInfo is not None:
+            generator.manual_seed(self.seed + self.epoch +
+                                  (workerInfo.id + 1) * 1000003)
+
+        buffer = []
+        position = 0
+        for shard in shards:
+            localIds = None
+            if workerInfo is not None:
+                # Runs of batchSize data points go to the workers in turn
+                numItems = self.shardLength(shard)
+                localIds = [
+                    localId for localId in range(numItems)
+                    if (position + localId) // self.batchSize %
+                    workerInfo.num_workers == workerInfo.id
+                ]
+                position += numItems
+                if not localIds:
+                    continue
+            for item in self.readShard(shard, localIds):
+                if not self.shuffle or self.shuffleBuffer <= 1:
+                    yield item
+                elif len(buffer) < self.shuffleBuffer:
+                    buffer.append(item)
+                else:
+                    # Emit a random buffered data point, keep the new one
+                    slot = torch.randint(len(buffer), (1,),
+                                         generator=generator).item()
+                    yield buffer[slot]
+                    buffer[slot] = item
+        for slot in torch.randperm(len(buffer), generator=generator).tolist():
+            yield buffer[slot]
+
+    def __len__(self):
+        return self.numDataPoints
+
+    def collate_fn(self, batch):
+        return collateItems(batch)
+
+
+class BatchPrefetcher(object):
+    def __init__(self, dataloader, depth=2, useGPU=False):
+        '''
+            Iterate over 'dataloader' while a background thread stages up
+            to 'depth' collated batches ahead of the consumer. Tensors are
+            made contiguous and, with 'useGPU', copied from pinned memory
+            to the GPU on a side stream, overlapping the copies with the
+            current training or evaluation step.
+
+            Counters: 'waitTime' is the time spent waiting for a batch,
+            'depthSum' the sum of staged batches found at every request.
+        '''
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.depth = depth
+        self.useGPU = useGPU
+        self.stream = torch.cuda.Stream() if useGPU else None
+        self.reset()
+
+    def reset(self):
+        self.numBatches = 0
+        self.waitTime = 0.0
+        self.depthSum = 0
+
+    def summary(self):
+        return '[Prefetch] %d batches, waited %.2fs (%.1fms per batch), ' \
+               'mean queue depth %.2f/%d' % (
+                   self.numBatches, self.waitTime,
+                   1000 * self.waitTime / max(self.numBatches, 1),
+                   self.depthSum / float(max(self.numBatches, 1)), self.depth)
+
+    def transfer(self, batch):
+        '''Move a collated batch to its target device'''
+        if not self.useGPU:
+            batch = {
+                key: v.contiguous() if torch.is_tensor(v) else v
+                for key, v in batch.items()
+            }
+            return batch, None
+        # Sequence lengths stay on the CPU for packing plans
+        with torch.cuda.stream(self.stream):
+            batch = {
+                key: v.contiguous().pin_memory().cuda(non_blocking=True)
+                if torch.is_tensor(v) and not key.endswith('_len') else v
+                for key, v in batch.items()
+            }
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return batch, event
+
+    def stage(self, staged, stop):
+        '''Producer thread putting (kind, value) entries into the queue'''
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    staged.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.dataloader:
+                if not put(('batch', self.transfer(batch))):
+                    return
+            put(('end', None))
+        except Exception as error:
+            put(('error', error))
+
+    def __iter__(self):
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.stage, args=(staged, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                self.depthSum += staged.qsize()
+                start = timer()
+                kind, value = staged.get()
+                self.waitTime += timer() - start
+                if kind == 'end':
+                    break
+                if kind == 'error':
+                    raise value
+                batch, event = value
+                if event is not None:
+                    currentStream = torch.cuda.current_stream()
+                    currentStream.wait_event(event)
+                    for v in batch.values():
+                        if torch.is_tensor(v):
+                            v.record_stream(currentStream)
+                self.numBatches += 1
+                yield batch
+        finally:
+            # Stop the producer when the consumer exits early
+            stop.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.dataloader)
 
 
 class VisDialDataset(Dataset):
@@ -26,12 +510,33 @@ class VisDialDataset(Dataset):
         self.useOptions = True
         self.useHistory = True
         self.useIm = True
+        # Read dataset arrays from disk on demand instead of up front
+        self.lazyLoad = False
+        # Directory for caching processed splits, disabled if empty
+        self.cacheDir = ''
+        # Store token tensors in the smallest integer type that fits
+        self.compactData = False
+        # In-memory image feature type, one of ['float32', 'float16', 'int8']
+        self.imgStorage = 'float32'
+        # Data points carry option indices, collate_fn gathers the options
+        self.poolOptions = False
+        # Place dataset tensors in shared memory for DataLoader workers
+        self.sharedMemory = False
+        # Batches per BucketBatchSampler pool, 0 disables length bucketing
+        self.bucketBatches = 0
+        # Batches staged ahead by BatchPrefetcher, 0 disables prefetching
+        self.prefetchBatches = 0
+        self.cocoDir = ''
 
         # Absorb parameters
         for key, value in iteritems(params):
             setattr(self, key, value)
         self.subsets = tuple(subsets)
         self.numRounds = params['numRounds']
+        if self.cacheDir and self.lazyLoad:
+            # Cached splits are memory-mapped, which is lazy already
+            print('Dataloader cache is memory-mapped, ignoring lazyLoad')
+            self.lazyLoad = False
 
         print('\nDataloader loading json file: ' + self.inputJson)
         with open(self.inputJson, 'r') as fileId:
@@ -56,18 +561,42 @@ class VisDialDataset(Dataset):
             for word, ind in iteritems(self.word2ind)
         }
 
-        # Read questions, answers and options
-        print('Dataloader loading h5 file: ' + self.inputQues)
-        quesFile = h5py.File(self.inputQues, 'r')
-
-        if self.useIm:
-            # Read images
-            print('Dataloader loading h5 file: ' + self.inputImg)
-            imgFile = h5py.File(self.inputImg, 'r')
-
         # Number of data points in each split (train/val/test)
         self.numDataPoints = {}
         self.data = {}
+        # Files backing the tensors memory-mapped from the cache
+        self.mappedFiles = {}
+        # Splits are read and processed when first selected as self.split
+        self.loadedSplits = []
+
+        # Only split sizes and available sequences are read up front
+        print('Dataloader reading h5 file: ' + self.inputQues)
+        with h5py.File(self.inputQues, 'r') as quesFile:
+            for dtype in subsets:  # dtype is in [train, val, test]
+                if ('ques_%s' % dtype) not in quesFile:
+                    self.useQuestion = False
+                if ('ans_%s' % dtype) not in quesFile:
+                    self.useAnswer = False
+                if ('opt_%s' % dtype) not in quesFile:
+                    self.useOptions = False
+                self.numDataPoints[dtype] = len(quesFile['cap_%s' % dtype])
+
+        # Default pytorch loader dtype is set to train
+        if 'train' in subsets:
+            self._split = 'train'
+        else:
+            self._split = subsets[0]
+
+    def loadSplit(self, dtype):
+        '''Read and process split 'dtype', unless it is loaded already'''
+        if dtype in self.loadedSplits:
+            return
+        print("\nProcessing split [%s]..." % dtype)
+        self.loadedSplits.append(dtype)
+        if self.cacheDir and self.loadCache(dtype):
+            if self.sharedMemory:
+                self.shareMemory(dtype)
+            return
 
         # map from load to save labels
         ioMap = {
@@ -81,79 +610,88 @@ class VisDialDataset(Dataset):
             'opt_length_%s': '%s_opt_len',
             'opt_list_%s': '%s_opt_list'
         }
+        # The option pool is shared by all data points, so it is always
+        # loaded (and processed) up front
+        poolLabels = ['%s_opt_len', '%s_opt_list']
 
-        # Processing every split in subsets
-        for dtype in subsets:  # dtype is in [train, val, test]
-            print("\nProcessing split [%s]..." % dtype)
-            if ('ques_%s' % dtype) not in quesFile:
-                self.useQuestion = False
-            if ('ans_%s' % dtype) not in quesFile:
-                self.useAnswer = False
-            if ('opt_%s' % dtype) not in quesFile:
-                self.useOptions = False
-            # read the question, answer, option related information
-            for loadLabel, saveLabel in iteritems(ioMap):
-                if loadLabel % dtype not in quesFile:
-                    continue
-                dataMat = np.array(quesFile[loadLabel % dtype], dtype='int64')
-                self.data[saveLabel % dtype] = torch.from_numpy(dataMat)
+        # Read questions, answers and options
+        print('Dataloader loading h5 file: ' + self.inputQues)
+        quesFile = h5py.File(self.inputQues, 'r')
+
+        if self.useIm:
+            # Read images
+            print('Dataloader loading h5 file: ' + self.inputImg)
+            imgFile = h5py.File(self.inputImg, 'r')
 
-            # Read image features, if needed
-            if self.useIm:
+        # read the question, answer, option related information
+        for loadLabel, saveLabel in iteritems(ioMap):
+            if loadLabel % dtype not in quesFile:
+                continue
+            if self.lazyLoad and saveLabel not in poolLabels:
+                self.data[saveLabel % dtype] = LazyH5Array(
+                    self.inputQues, loadLabel % dtype)
+                continue
+            dataMat = np.array(quesFile[loadLabel % dtype], dtype='int64')
+            self.data[saveLabel % dtype] = torch.from_numpy(dataMat)
+
+        # Read image features, if needed
+        if self.useIm:
+            if self.lazyLoad:
+                # Rows are read (and normalized) in getIndexItem
+                self.data['%s_img_fv' % dtype] = LazyH5Array(
+                    self.inputImg, 'images_' + dtype)
+            else:
                 print('Reading image features...')
                 imgFeats = np.array(imgFile['images_' + dtype])
 
-                if not self.imgNorm:
-                    continue
                 # normalize, if needed
-                print('Normalizing image features..')
-                imgFeats = normalize(imgFeats, axis=1, norm='l2')
+                if self.imgNorm:
+                    print('Normalizing image features..')
+                    imgFeats = normalize(imgFeats, axis=1, norm='l2')
 
                 # save img features
                 self.data['%s_img_fv' % dtype] = torch.FloatTensor(imgFeats)
-                # Visdial
-                if hasattr(self, 'unique_img_train') and params['cocoDir']:
-                    coco_dir = params['cocoDir']
-                    with open(params['cocoInfo'], 'r') as f:
-                        coco_info = json.load(f)
-                    id_to_fname = {
-                        im['id']: im['file_name']  # Change 'file_path' to 'file_name'
-                        for im in coco_info['images']
-                    }
-                    cocoids = getattr(self, 'unique_img_%s' % dtype)
-                    if '.jpg' not in cocoids[0]:
-                        img_fnames = [
-                            os.path.join(coco_dir, id_to_fname[int(cocoid)])
-                            for cocoid in cocoids
-                        ]
-                    else:
-                        img_fnames = cocoids
-                    self.data['%s_img_fnames' % dtype] = img_fnames
-
-            # read the history, if needed
-            if self.useHistory:
-                captionMap = {
-                    'cap_%s': '%s_cap',
-                    'cap_length_%s': '%s_cap_len'
-                }
-                for loadLabel, saveLabel in iteritems(captionMap):
-                    mat = np.array(quesFile[loadLabel % dtype], dtype='int32')
-                    self.data[saveLabel % dtype] = torch.from_numpy(mat)
+            self.readImageFileNames(dtype)
 
-            # Number of data points
-            self.numDataPoints[dtype] = self.data[dtype + '_cap'].size(0)
+        # read the history, if needed
+        if self.useHistory:
+            captionMap = {
+                'cap_%s': '%s_cap',
+                'cap_length_%s': '%s_cap_len'
+            }
+            for loadLabel, saveLabel in iteritems(captionMap):
+                if self.lazyLoad:
+                    self.data[saveLabel % dtype] = LazyH5Array(
+                        self.inputQues, loadLabel % dtype)
+                    continue
+                mat = np.array(quesFile[loadLabel % dtype], dtype='int32')
+                self.data[saveLabel % dtype] = torch.from_numpy(mat)
 
-        # Prepare dataset for training
-        for dtype in subsets:
-            print("\nSequence processing for [%s]..." % dtype)
-            self.prepareDataset(dtype)
+        quesFile.close()
+        if self.useIm:
+            imgFile.close()
+
+        print("\nSequence processing for [%s]..." % dtype)
+        self.prepareDataset(dtype)
+        if self.compactData:
+            self.compactTensors(dtype)
+        if self.imgStorage != 'float32':
+            self.storeImageFeatures(dtype)
+        if self.cacheDir:
+            self.saveCache(dtype)
+        if self.sharedMemory:
+            self.shareMemory(dtype)
         print("")
 
-        # Default pytorch loader dtype is set to train
-        if 'train' in subsets:
-            self._split = 'train'
-        else:
-            self._split = subsets[0]
+    def releaseSplit(self, dtype):
+        '''Free the tensors of split 'dtype', it is reloaded when selected'''
+        if dtype not in self.loadedSplits:
+            return
+        self.loadedSplits.remove(dtype)
+        for key in list(self.data):
+            if key.startswith(dtype + '_'):
+                del self.data[key]
+                self.mappedFiles.pop(key, None)
 
     @property
     def split(self):
@@ -162,13 +700,237 @@ class VisDialDataset(Dataset):
     @split.setter
     def split(self, split):
         assert split in self.subsets  # ['train', 'val', 'test']
+        self.loadSplit(split)
         self._split = split
 
+    def readImageFileNames(self, dtype):
+        # Visdial
+        if hasattr(self, 'unique_img_train') and self.cocoDir:
+            coco_dir = self.cocoDir
+            with open(self.cocoInfo, 'r') as f:
+                coco_info = json.load(f)
+            id_to_fname = {
+                im['id']: im['file_name']  # Change 'file_path' to 'file_name'
+                for im in coco_info['images']
+            }
+            cocoids = getattr(self, 'unique_img_%s' % dtype)
+            if '.jpg' not in cocoids[0]:
+                img_fnames = [
+                    os.path.join(coco_dir, id_to_fname[int(cocoid)])
+                    for cocoid in cocoids
+                ]
+            else:
+                img_fnames = cocoids
+            self.data['%s_img_fnames' % dtype] = img_fnames
+
+    #----------------------------------------------------------------------------
+    # Processed dataset cache
+    #----------------------------------------------------------------------------
+
+    def cachePath(self, dtype):
+        '''
+        Cache directory of split 'dtype'. The directory name contains a
+        fingerprint of the input files (path, size and modification time)
+        and of the options which change the processed tensors, so stale
+        caches are never read.
+        '''
+        fingerprint = hashlib.sha1()
+        inputFiles = [self.inputQues, self.inputJson]
+        if self.useIm:
+            inputFiles.append(self.inputImg)
+        for fileName in inputFiles:
+            fileStat = os.stat(fileName)
+            fingerprint.update(('%s:%d:%d;' % (os.path.abspath(fileName),
+                fileStat.st_size, int(fileStat.st_mtime))).encode('utf-8'))
+        config = [dtype, self.imgNorm, bool(self.useIm), self.useHistory,
+                  bool(self.compactData), self.imgStorage]
+        fingerprint.update(json.dumps(config).encode('utf-8'))
+        cacheName = '%s_%s' % (dtype, fingerprint.hexdigest()[:16])
+        return os.path.join(self.cacheDir, cacheName)
+
+    def saveCache(self, dtype):
+        '''Save the processed tensors of split 'dtype' as .npy files'''
+        cachePath = self.cachePath(dtype)
+        if os.path.isdir(cachePath):
+            return
+        print('Writing dataset cache: ' + cachePath)
+        # Write to a temporary directory first so that interrupted or
+        # concurrent runs never leave a partial cache behind
+        tempPath = '%s.tmp%d' % (cachePath, os.getpid())
+        os.makedirs(tempPath)
+        keys = [
+            key for key, value in iteritems(self.data)
+            if key.startswith(dtype + '_') and torch.is_tensor(value)
+        ]
+        for key in keys:
+            np.save(os.path.join(tempPath, key + '.npy'),
+                    self.data[key].numpy())
+        info = {
+            'keys': keys,
+            'numDataPoints': self.numDataPoints[dtype],
+            'useQuestion': (dtype + '_ques') in self.data,
+            'useAnswer': (dtype + '_ans') in self.data,
+            'useOptions': (dtype + '_opt') in self.data,
+        }
+        with open(os.path.join(tempPath, 'info.json'), 'w') as fileId:
+            json.dump(info, fileId)
+        try:
+            os.rename(tempPath, cachePath)
+        except OSError:
+            # Another process finished writing the same cache first
+            for fileName in os.listdir(tempPath):
+                os.remove(os.path.join(tempPath, fileName))
+            os.rmdir(tempPath)
+        # Swap in the memory-mapped copies to release the processed tensors
+        self.loadCache(dtype)
+
+    def loadCache(self, dtype):
+        '''
+        Load split 'dtype' from its cache, if present. Arrays are memory
+        mapped copy-on-write, so pages are only read when indexed and are
+        shared through the page cache by all processes reading them.
+
+        Returns True if the split was loaded from cache.
+        '''
+        cachePath = self.cachePath(dtype)
+        infoFile = os.path.join(cachePath, 'info.json')
+        if not os.path.isfile(infoFile):
+            return False
+        print('Dataloader loading cache: ' + cachePath)
+        with open(infoFile, 'r') as fileId:
+            info = json.load(fileId)
+        for key in info['keys']:
+            fileName = os.path.join(cachePath, key + '.npy')
+            self.data[key] = torch.from_numpy(np.load(fileName, mmap_mode='c'))
+            self.mappedFiles[key] = fileName
+        self.numDataPoints[dtype] = info['numDataPoints']
+        self.useQuestion = self.useQuestion and info['useQuestion']
+        self.useAnswer = self.useAnswer and info['useAnswer']
+        self.useOptions = self.useOptions and info['useOptions']
+        if self.useIm:
+            self.readImageFileNames(dtype)
+        return True
+
+    #----------------------------------------------------------------------------
+    # Sharing dataset tensors with DataLoader workers
+    #----------------------------------------------------------------------------
+
+    def shareMemory(self, dtype):
+        '''
+        Move tensors of split 'dtype' to shared memory. DataLoader workers then
+        map the same pages, instead of receiving a pickled copy (spawn) or
+        privately copying pages as they are written (fork). Tensors mapped
+        from the cache are shared through the page cache already.
+        '''
+        numBytes = 0
+        for key, value in iteritems(self.data):
+            if not key.startswith(dtype + '_') or key in self.mappedFiles:
+                continue
+            if torch.is_tensor(value):
+                value.share_memory_()
+                numBytes += value.numel() * value.element_size()
+        print('Moved %.1fMB of dataset tensors to shared memory' %
+              (numBytes / 2.0**20))
+
+    def __getstate__(self):
+        # Cache-backed tensors are re-mapped from their files when
+        # unpickled (e.g. in spawned workers) rather than copied
+        state = self.__dict__.copy()
+        state['data'] = {
+            key: value
+            for key, value in iteritems(self.data)
+            if key not in self.mappedFiles
+        }
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key, fileName in iteritems(self.mappedFiles):
+            self.data[key] = torch.from_numpy(np.load(fileName, mmap_mode='c'))
+
+    #----------------------------------------------------------------------------
+    # Streaming shards
+    #----------------------------------------------------------------------------
+
+    def writeShards(self, dtype, shardDir, shardSize):
+        '''
+        Write split 'dtype' to 'shardDir' as shards of 'shardSize' data
+        points, read back by VisDialShards. Shards store data points as
+        returned by getIndexItem, with options replaced by indices into a
+        shard-local option pool.
+
+        A split that is not loaded yet is read lazily (one data point at a
+        time, as with lazyLoad) and released afterwards, so splits larger
+        than memory can be sharded. Shards then hold int64 tokens and
+        float32 image features, regardless of compactData and imgStorage.
+        '''
+        manifestPath = VisDialShards.manifestPath(shardDir, dtype)
+        if os.path.isfile(manifestPath):
+            return
+        print('Writing dataset shards: ' + shardDir)
+        wasLoaded = dtype in self.loadedSplits
+        if not wasLoaded:
+            lazyLoad, cacheDir = self.lazyLoad, self.cacheDir
+            self.lazyLoad, self.cacheDir = True, ''
+            try:
+                self.loadSplit(dtype)
+            finally:
+                self.lazyLoad, self.cacheDir = lazyLoad, cacheDir
+        if not os.path.isdir(shardDir):
+            os.makedirs(shardDir)
+        # Read option indices instead of option sequences
+        poolOptions = self.poolOptions
+        self.poolOptions = True
+        shards = []
+        try:
+            numDataPoints = self.numDataPoints[dtype]
+            for start in range(0, numDataPoints, shardSize):
+                end = min(start + shardSize, numDataPoints)
+                items = [self.getIndexItem(dtype, idx)
+                         for idx in range(start, end)]
+                arrays = {
+                    key: torch.stack([item[key] for item in items])
+                    for key in items[0] if key != 'index'
+                }
+                arrays['index'] = torch.arange(start, end)
+                if 'opt_ind' in arrays:
+                    poolInds, optInds = torch.unique(
+                        arrays['opt_ind'], return_inverse=True)
+                    arrays['opt_pool'] = self.data[dtype + '_opt_seq'][poolInds]
+                    arrays['opt_ind'] = optInds.int()
+
+                shard = '%s_%05d' % (dtype, len(shards))
+                shardPath = os.path.join(shardDir, shard)
+                if not os.path.isdir(shardPath):
+                    os.makedirs(shardPath)
+                for key, value in iteritems(arrays):
+                    np.save(os.path.join(shardPath, key + '.npy'),
+                            value.numpy())
+                with open(os.path.join(shardPath, 'info.json'), 'w') as fileId:
+                    json.dump({'keys': sorted(arrays)}, fileId)
+                shards.append(shard)
+        finally:
+            self.poolOptions = poolOptions
+            if not wasLoaded:
+                self.releaseSplit(dtype)
+
+        # The manifest is written last, marking the shards as complete
+        info = {'shards': shards, 'numDataPoints': numDataPoints}
+        with open(manifestPath, 'w') as fileId:
+            json.dump(info, fileId)
+
     #----------------------------------------------------------------------------
     # Dataset preprocessing
     #----------------------------------------------------------------------------
 
     def prepareDataset(self, dtype):
+        if self.lazyLoad:
+            # Only the shared option pool is processed here, data points
+            # are processed as they are read in getIndexItem
+            if self.useOptions:
+                self.processOptions(dtype)
+            return
+
         if self.useHistory:
             self.processCaption(dtype)
 
@@ -186,6 +948,115 @@ class VisDialDataset(Dataset):
         if self.useQuestion:
             self.processSequence(dtype, stype='ques')
 
+    def compactTensors(self, dtype):
+        '''
+        Store every integer tensor of split 'dtype' in the smallest integer
+        type that holds its values (tokens fit in int16, lengths in uint8).
+        Batches are widened back to int64 in collate_fn.
+        '''
+        compactTypes = [torch.uint8, torch.int16, torch.int32, torch.int64]
+        numBytes, numCompactBytes = 0, 0
+        for key, value in list(iteritems(self.data)):
+            if not key.startswith(dtype + '_') or not torch.is_tensor(value):
+                continue
+            numBytes += value.numel() * value.element_size()
+            if not value.is_floating_point() and value.numel() > 0:
+                minValue, maxValue = value.min().item(), value.max().item()
+                for compactType in compactTypes:
+                    typeInfo = torch.iinfo(compactType)
+                    if typeInfo.min <= minValue and maxValue <= typeInfo.max:
+                        break
+                value = value.to(compactType)
+                self.data[key] = value
+            numCompactBytes += value.numel() * value.element_size()
+        print('Compact storage for [%s]: %.1fMB -> %.1fMB' %
+              (dtype, numBytes / 2.0**20, numCompactBytes / 2.0**20))
+
+    def storeImageFeatures(self, dtype):
+        '''
+        Store image features of split 'dtype' in reduced precision, either
+        as float16 or as int8 with one float32 scale per row (symmetric
+        quantization to [-127, 127]). Features are converted back to
+        float32 in collate_fn.
+        '''
+        key = dtype + '_img_fv'
+        if not torch.is_tensor(self.data.get(key)):
+            return
+        imgFeats = self.data[key].float()
+        if self.imgStorage == 'float16':
+            stored = imgFeats.new_empty(imgFeats.size(), dtype=torch.float16)
+        elif self.imgStorage == 'int8':
+            stored = imgFeats.new_empty(imgFeats.size(), dtype=torch.int8)
+            scale = imgFeats.new_empty(imgFeats.size(0))
+        else:
+            raise ValueError("Unknown imgStorage '%s'" % self.imgStorage)
+
+        # Convert in chunks of rows to bound the memory used by temporaries
+        maxError, minCosine = 0.0, 1.0
+        for start in range(0, imgFeats.size(0), 4096):
+            chunk = imgFeats[start:start + 4096]
+            if self.imgStorage == 'float16':
+                stored[start:start + 4096] = chunk
+                restored = stored[start:start + 4096].float()
+            else:
+                chunkScale = chunk.abs().max(1)[0] / 127.0
+                chunkScale.masked_fill_(chunkScale.eq(0), 1.0)
+                stored[start:start + 4096] = torch.round(
+                    chunk / chunkScale.unsqueeze(1))
+                scale[start:start + 4096] = chunkScale
+                restored = stored[start:start + 4096].float()
+                restored *= chunkScale.unsqueeze(1)
+            maxError = max(maxError, (restored - chunk).abs().max().item())
+            minCosine = min(minCosine, F.cosine_similarity(
+                restored, chunk, dim=1).min().item())
+
+        self.data[key] = stored
+        if self.imgStorage == 'int8':
+            self.data[dtype + '_img_scale'] = scale
+        print('Image features stored as %s: %.1fMB -> %.1fMB, max abs error'\
+              ' %.2e, min cosine %.6f' % (self.imgStorage,
+              imgFeats.numel() * 4 / 2.0**20,
+              stored.numel() * stored.element_size() / 2.0**20,
+              maxError, minCosine))
+
+    def addStartEnd(self, seq, seqLen, stype):
+        '''
+        Add <START> and <END> token to a left-aligned (right padded) set of
+        sequences.
+        Arguments:
+            'seq'    : (..., maxLen) sized tensor of tokens
+            'seqLen' : (...) sized tensor of sequence lengths
+            'stype'  : Sequence type, only used in warnings
+        Returns:
+            A (..., maxLen + 2) sized LongTensor of sequences
+        '''
+        size = list(seq.size())
+        maxLen = size[-1]
+        seq = seq.contiguous().view(-1, maxLen).long()
+        seqLen = seqLen.contiguous().view(-1).long()
+
+        # Tokens past each sequence length are zeroed, as is padding
+        positions = torch.arange(maxLen).unsqueeze(0)
+        tokenMask = positions < seqLen.unsqueeze(1)
+        sequence = torch.LongTensor(seq.size(0), maxLen + 2).fill_(0)
+        sequence[:, 1:maxLen + 1] = seq * tokenMask.long()
+
+        # decodeIn begins with <START>, <END> follows the last token. Empty
+        # sequences have nothing to end, so their <END> 'lands' on <START>
+        isEmpty = seqLen.eq(0)
+        endPositions = (seqLen + 1).masked_fill(isEmpty, 0).unsqueeze(1)
+        endTokens = torch.LongTensor(seq.size(0), 1).fill_(self.endToken)
+        endTokens.masked_fill_(isEmpty.unsqueeze(1), self.startToken)
+        sequence[:, 0] = self.startToken
+        sequence.scatter_(1, endPositions, endTokens)
+
+        for seqId in isEmpty.nonzero().view(-1).tolist():
+            position = np.unravel_index(seqId, size[:-1])
+            print('Warning: Skipping empty %s sequence at %s'\
+                  %(stype, tuple(int(p) for p in position)))
+
+        return sequence.view(size[:-1] + [maxLen + 2])
+
     def processSequence(self, dtype, stype='ans'):
         '''
         Add <START> and <END> token to answers or questions.
@@ -199,28 +1070,9 @@ class VisDialDataset(Dataset):
         seq = self.data[prefix]
         seqLen = self.data[prefix + '_len']
 
-        numConvs, numRounds, maxAnsLen = seq.size()
-        newSize = torch.Size([numConvs, numRounds, maxAnsLen + 2])
-        sequence = torch.LongTensor(newSize).fill_(0)
-
-        # decodeIn begins with <START>
-        sequence[:, :, 0] = self.word2ind['<START>']
-        endTokenId = self.word2ind['<END>']
-
-        for thId in range(numConvs):
-            for rId in range(numRounds):
-                length = seqLen[thId, rId]
-                if length == 0:
-                    print('Warning: Skipping empty %s sequence at (%d, %d)'\
-                          %(stype, thId, rId))
-                    continue
-
-                sequence[thId, rId, 1:length + 1] = seq[thId, rId, :length]
-                sequence[thId, rId, length + 1] = endTokenId
-
         # Sequence length is number of tokens + 1
         self.data[prefix + "_len"] = seqLen + 1
-        self.data[prefix] = sequence
+        self.data[prefix] = self.addStartEnd(seq, seqLen, stype)
 
     def processCaption(self, dtype):
         '''
@@ -233,58 +1085,41 @@ class VisDialDataset(Dataset):
         seq = self.data[prefix]
         seqLen = self.data[prefix + '_len']
 
-        numConvs, maxCapLen = seq.size()
-        newSize = torch.Size([numConvs, maxCapLen + 2])
-        sequence = torch.LongTensor(newSize).fill_(0)
-
-        # decodeIn begins with <START>
-        sequence[:, 0] = self.word2ind['<START>']
-        endTokenId = self.word2ind['<END>']
-
-        for thId in range(numConvs):
-            length = seqLen[thId]
-            if length == 0:
-                print('Warning: Skipping empty %s sequence at (%d)' % (stype,
-                                                                       thId))
-                continue
-
-            sequence[thId, 1:length + 1] = seq[thId, :length]
-            sequence[thId, length + 1] = endTokenId
-
         # Sequence length is number of tokens + 1
         self.data[prefix + "_len"] = seqLen + 1
-        self.data[prefix] = sequence
+        self.data[prefix] = self.addStartEnd(seq, seqLen, 'cap')
 
     def processOptions(self, dtype):
         ans = self.data[dtype + '_opt_list']
         ansLen = self.data[dtype + '_opt_len']
 
-        ansListLen, maxAnsLen = ans.size()
-
-        newSize = torch.Size([ansListLen, maxAnsLen + 2])
-        options = torch.LongTensor(newSize).fill_(0)
-
-        # decodeIn begins with <START>
-        options[:, 0] = self.word2ind['<START>']
-        endTokenId = self.word2ind['<END>']
-
-        for ansId in range(ansListLen):
-            length = ansLen[ansId]
-            if length == 0:
-                print('Warning: Skipping empty option answer list at (%d)'\
-                        %ansId)
-                continue
-
-            options[ansId, 1:length + 1] = ans[ansId, :length]
-            options[ansId, length + 1] = endTokenId
-
         self.data[dtype + '_opt_len'] = ansLen + 1
-        self.data[dtype + '_opt_seq'] = options
+        self.data[dtype + '_opt_seq'] = self.addStartEnd(ans, ansLen, 'opt')
 
     #----------------------------------------------------------------------------
     # Dataset helper functions for PyTorch's dataloader
     #----------------------------------------------------------------------------
 
+    def getLengthProfile(self, dtype):
+        '''
+        Returns a (numDataPoints, 3) LongTensor holding the caption length,
+        the longest question and the longest answer of every dialog in
+        split 'dtype' (0 for sequences which are not used).
+        '''
+        lengths = torch.LongTensor(self.numDataPoints[dtype], 3).fill_(0)
+        for column, stype in enumerate(['cap', 'ques', 'ans']):
+            key = '%s_%s_len' % (dtype, stype)
+            if key not in self.data:
+                continue
+            seqLen = self.data[key]
+            if isinstance(seqLen, LazyH5Array):
+                # Not processed yet, so add the <START>/<END> token
+                seqLen = seqLen.readAll().astype('int64')
+                seqLen = torch.from_numpy(seqLen) + 1
+            seqLen = seqLen.long().view(lengths.size(0), -1)
+            lengths[:, column] = seqLen.max(1)[0]
+        return lengths
+
     def __len__(self):
         # Assert that loader_dtype is in subsets ['train', 'val', 'test']
         return self.numDataPoints[self._split]
@@ -294,34 +1129,19 @@ class VisDialDataset(Dataset):
         return item
 
     def collate_fn(self, batch):
-        out = {}
-
-        mergedBatch = {key: [d[key] for d in batch] for key in batch[0]}
-        for key in mergedBatch:
-            if key == 'img_fname' or key == 'index':
-                out[key] = mergedBatch[key]
-            elif key == 'cap_len':
-                # 'cap_lens' are single integers, need special treatment
-                out[key] = torch.LongTensor(mergedBatch[key])
-            else:
-                out[key] = torch.stack(mergedBatch[key], 0)
-
-        # Dynamic shaping of padded batch
-        if 'ques' in out.keys():
-            quesLen = out['ques_len'] + 1
-            out['ques'] = out['ques'][:, :, :torch.max(quesLen)].contiguous()
-
-        if 'ans' in out.keys():
-            ansLen = out['ans_len'] + 1
-            out['ans'] = out['ans'][:, :, :torch.max(ansLen)].contiguous()
-
-        if 'cap' in out.keys():
-            capLen = out['cap_len'] + 1
-            out['cap'] = out['cap'][:, :torch.max(capLen)].contiguous()
-
-        if 'opt' in out.keys():
+        out = collateItems(batch)
+
+        # Gather options from the option pool of the split once per batch,
+        # keeping a single copy of options repeated within the batch
+        if 'opt_ind' in out.keys():
+            poolInds, optInds = torch.unique(
+                out['opt_ind'], return_inverse=True)
+            optPool = self.data[self._split + '_opt_seq'].index_select(
+                0, poolInds)
             optLen = out['opt_len'] + 1
-            out['opt'] = out['opt'][:, :, :, :torch.max(optLen) + 2].contiguous()
+            optPool = optPool[:, :torch.max(optLen) + 2]
+            out['opt_pool'] = optPool.long().contiguous()
+            out['opt_ind'] = optInds
 
         return out
 
@@ -329,50 +1149,86 @@ class VisDialDataset(Dataset):
     # Dataset indexing
     #----------------------------------------------------------------------------
 
+    def readItem(self, key, idx):
+        '''
+        Read data point 'idx' of self.data[key]. Lazily loaded arrays are
+        read from disk and returned as a LongTensor.
+        '''
+        value = self.data[key]
+        if isinstance(value, LazyH5Array):
+            return torch.from_numpy(value[idx].astype('int64'))
+        return value[idx]
+
+    def readSequence(self, dtype, stype, idx):
+        '''
+        Read sequence 'stype' of data point 'idx' along with its length.
+        Lazily loaded sequences have not been through prepareDataset, so
+        <START> and <END> tokens are added here.
+        '''
+        prefix = dtype + '_' + stype
+        seq = self.readItem(prefix, idx)
+        seqLen = self.readItem(prefix + '_len', idx)
+        if isinstance(self.data[prefix], LazyH5Array):
+            seq = self.addStartEnd(seq, seqLen, stype)
+            seqLen = seqLen + 1
+        return seq, seqLen
+
     def getIndexItem(self, dtype, idx):
         item = {'index': idx}
 
         # get question
         if self.useQuestion:
-            ques = self.data[dtype + '_ques'][idx]
-            quesLen = self.data[dtype + '_ques_len'][idx]
+            ques, quesLen = self.readSequence(dtype, 'ques', idx)
             item['ques'] = ques
             item['ques_len'] = quesLen
 
         # get answer
         if self.useAnswer:
-            ans = self.data[dtype + '_ans'][idx]
-            ansLen = self.data[dtype + '_ans_len'][idx]
+            ans, ansLen = self.readSequence(dtype, 'ans', idx)
             item['ans_len'] = ansLen
             item['ans'] = ans
 
         # get caption
         if self.useHistory:
-            cap = self.data[dtype + '_cap'][idx]
-            capLen = self.data[dtype + '_cap_len'][idx]
+            cap, capLen = self.readSequence(dtype, 'cap', idx)
             item['cap'] = cap
             item['cap_len'] = capLen
 
         if self.useOptions:
-            optInds = self.data[dtype + '_opt'][idx]
-            ansId = self.data[dtype + '_ans_ind'][idx]
+            optInds = self.readItem(dtype + '_opt', idx)
+            ansId = self.readItem(dtype + '_ans_ind', idx)
+            if isinstance(self.data[dtype + '_opt'], LazyH5Array):
+                # 1-indexed to 0-indexed
+                optInds = optInds - 1
+                ansId = ansId - 1
 
             optSize = list(optInds.size())
             newSize = torch.Size(optSize + [-1])
 
-            indVector = optInds.view(-1)
+            indVector = optInds.view(-1).long()
             optLens = self.data[dtype + '_opt_len'].index_select(0, indVector)
             optLens = optLens.view(optSize)
 
-            opts = self.data[dtype + '_opt_seq'].index_select(0, indVector)
-
-            item['opt'] = opts.view(newSize)
+            if self.poolOptions:
+                item['opt_ind'] = indVector.view(optSize)
+            else:
+                opts = self.data[dtype + '_opt_seq'].index_select(0, indVector)
+                item['opt'] = opts.view(newSize)
             item['opt_len'] = optLens
             item['ans_id'] = ansId
 
         # if image needed
         if self.useIm:
-            item['img_feat'] = self.data[dtype + '_img_fv'][idx]
+            imgFeat = self.data[dtype + '_img_fv']
+            if isinstance(imgFeat, LazyH5Array):
+                imgFeat = imgFeat[idx:idx + 1]
+                if self.imgNorm:
+                    imgFeat = normalize(imgFeat, axis=1, norm='l2')
+                item['img_feat'] = torch.FloatTensor(imgFeat[0])
+            else:
+                item['img_feat'] = imgFeat[idx]
+                if dtype + '_img_scale' in self.data:
+                    item['img_scale'] = self.data[dtype + '_img_scale'][idx]
             # item['img_fname'] = self.data[dtype + '_img_fnames'][idx]
             if dtype + '_img_labels' in self.data:
                 item['img_label'] = self.data[dtype + '_img_labels'][idx]
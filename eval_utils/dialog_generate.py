@@ -10,7 +10,7 @@ from torch.autograd import Variable
 import options
 import visdial.metrics as metrics
 from utils import utilities as utils
-from dataloader import VisDialDataset
+from dataloader import VisDialDataset, BucketBatchSampler, BatchPrefetcher
 from torch.utils.data import DataLoader
 
 from sklearn.metrics.pairwise import pairwise_distances
@@ -42,12 +42,25 @@ def dialogDump(params,
         length = l.item()  # Convert length tensor to Python scalar
         return " ".join([ind2word[x.item()] for x in w.data.cpu().numpy()[:length] if x > 0])
 
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batchSize,
-        shuffle=False,
-        num_workers=0,
-        collate_fn=dataset.collate_fn)
+    if dataset.bucketBatches:
+        sampler = BucketBatchSampler(
+            dataset, batchSize, poolBatches=dataset.bucketBatches,
+            shuffle=False)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batchSize,
+            shuffle=False,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    if dataset.prefetchBatches:
+        dataloader = BatchPrefetcher(
+            dataloader, dataset.prefetchBatches, useGPU=dataset.useGPU)
     print(1)
     text = {'data': []}
     if '%s_img_fnames' % split not in dataset.data.keys():
@@ -67,8 +80,9 @@ def dialogDump(params,
         imgIds = [getImgId(x) for x in batch['index']]
         dialog = [{'dialog': [], 'image_id': imgId} for imgId in imgIds]
 
+        # Sequence lengths stay on the CPU for packing plans
         if dataset.useGPU:
-            batch = {key: v.cuda() if isinstance(v, torch.Tensor) else v for key, v in batch.items()}
+            batch = {key: v.cuda() if isinstance(v, torch.Tensor) and not key.endswith('_len') else v for key, v in batch.items()}
 
         image = Variable(batch['img_feat'], volatile=True)
         caption = Variable(batch['cap'], volatile=True)
@@ -129,6 +143,8 @@ def dialogDump(params,
                     "question": question_str[8:] + " "
                 })  # "8:" for indexing out initial <START>
         text['data'].extend(dialog)
+    if dataset.prefetchBatches:
+        print(dataloader.summary())
 
     text['opts'] = {
         'qbot': params['qstartFrom'],
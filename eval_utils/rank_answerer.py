@@ -10,7 +10,8 @@ from torch.autograd import Variable
 import options
 import visdial.metrics as metrics
 from utils import utilities as utils
-from dataloader import VisDialDataset
+from dataloader import VisDialDataset, BucketBatchSampler, gatherOptions
+from dataloader import BatchPrefetcher
 from torch.utils.data import DataLoader
 
 from sklearn.metrics.pairwise import pairwise_distances
@@ -18,6 +19,13 @@ from sklearn.metrics.pairwise import pairwise_distances
 from six.moves import range
 
 
+def syncTimer(device):
+    '''Timer read after all queued CUDA work on device has finished'''
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return timer()
+
+
 def rankOptions(options, gtOptions, scores):
     '''Rank a batch of examples against a list of options.'''
     numOptions = options.size(1)
@@ -30,7 +38,8 @@ def rankOptions(options, gtOptions, scores):
     return ranks + 1
 
 
-def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
+def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None,
+             numCandidates=0, optionMemory=0):
     '''
         Evaluate A-Bot performance on ranking answer option when it is
         shown ground truth image features, captions and questions.
@@ -44,8 +53,23 @@ def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
                               likelihood of a sequence (answer) given log
                               probabilities under an RNN model. Currently
                               utils.maskedNll is the only such function used.
+                              If None, the fused scoring of
+                              Decoder.forwardNll is used instead.
             exampleLimit    : Maximum number of data points to use from
                               the dataset split. If None, all data points.
+            numCandidates   : If non-zero, options are pruned to this many
+                              candidates by a first stage scorer before
+                              decoder scoring (see Decoder.evalOptions).
+                              The recall of ground truth options among the
+                              candidates is reported as 'candidateRecall',
+                              and the speedup of option scoring over
+                              scoring all options, measured on the first
+                              batch, as 'candidateSpeedup'.
+            optionMemory    : If non-zero, memory budget in MB for scoring
+                              the options of a batch, which are then scored
+                              in chunks (see Decoder.evalOptionsChunked).
+                              This decouples batchSize from option scoring
+                              memory.
     '''
     batchSize = dataset.batchSize
     numRounds = dataset.numRounds
@@ -58,24 +82,40 @@ def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
 
     original_split = dataset.split
     dataset.split = split
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batchSize,
-        shuffle=True,
-        num_workers=1,
-        collate_fn=dataset.collate_fn)
+    if dataset.bucketBatches:
+        sampler = BucketBatchSampler(
+            dataset, batchSize, poolBatches=dataset.bucketBatches)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=1,
+            collate_fn=dataset.collate_fn)
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batchSize,
+            shuffle=True,
+            num_workers=1,
+            collate_fn=dataset.collate_fn)
+    if dataset.prefetchBatches:
+        dataloader = BatchPrefetcher(
+            dataloader, dataset.prefetchBatches, useGPU=dataset.useGPU)
 
     totalLoss, totalTokens = 0, 0
-    ranks = []
+    rankAccumulator = metrics.RankAccumulator(numRounds)
+    candidateHits = []
+    stageTimes = [0.0, 0.0]
     logProbsAll = [[] for _ in range(numRounds)]
     start_t = timer()
     for idx, batch in enumerate(dataloader):
         if idx == numBatches:
             break
 
+        # Sequence lengths stay on the CPU for packing plans
         if dataset.useGPU:
             batch = {
-                key: v.cuda() if hasattr(v, 'cuda') else v
+                key: v.cuda()
+                if hasattr(v, 'cuda') and not key.endswith('_len') else v
                 for key, v in batch.items()
             }
         else:
@@ -92,7 +132,6 @@ def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
               quesLens = batch['ques_len']
               answers = batch['ans']
               ansLens = batch['ans_len']
-              options = batch['opt']
               optionLens = batch['opt_len']
               correctOptionInds = batch['ans_id']
         aBot.reset()
@@ -104,15 +143,34 @@ def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
                 quesLens=quesLens[:, round],
                 ans=answers[:, round],
                 ansLens=ansLens[:, round])
-            logProbs = aBot.evalOptions(options[:, round],
-                                        optionLens[:, round], scoringFunction)
-            logProbsCurrent = aBot.forward()
-            logProbsAll[round].append(
-                scoringFunction(logProbsCurrent,
-                                answers[:, round].contiguous()))
-            batchRanks = rankOptions(options[:, round],
-                                     correctOptionInds[:, round], logProbs)
-            ranks.append(batchRanks)
+            options = gatherOptions(batch, round)
+            optStart = syncTimer(options.device)
+            logProbs = aBot.evalOptions(options, optionLens[:, round],
+                                        scoringFunction, numCandidates,
+                                        optionMemory)
+            candidates = aBot.decoder.optionCandidates
+            if candidates is not None:
+                # Time scoring of all options on the first batch, skipping
+                # round 0 to leave out warm up
+                if idx == 0 and round > 0:
+                    stageTimes[0] += syncTimer(options.device) - optStart
+                    optStart = syncTimer(options.device)
+                    aBot.evalOptions(options, optionLens[:, round],
+                                     scoringFunction,
+                                     memoryBudget=optionMemory)
+                    stageTimes[1] += syncTimer(options.device) - optStart
+                gtInds = correctOptionInds[:, round].unsqueeze(1)
+                candidateHits.append(candidates.eq(gtInds).any(1))
+            if scoringFunction is None:
+                logProbsAll[round].append(aBot.forward(returnNll=True))
+            else:
+                logProbsCurrent = aBot.forward()
+                logProbsAll[round].append(
+                    scoringFunction(logProbsCurrent,
+                                    answers[:, round].contiguous()))
+            batchRanks = rankOptions(options, correctOptionInds[:, round],
+                                     logProbs)
+            rankAccumulator.update(batchRanks, round)
 
         end_t = timer()
         delta_t = " Rate: %5.2fs" % (end_t - start_t)
@@ -121,10 +179,19 @@ def rankABot(aBot, dataset, split, scoringFunction, exampleLimit=None):
         sys.stdout.write(progressString % (split, idx + 1, numBatches))
         sys.stdout.flush()
     sys.stdout.write("\n")
+    if dataset.prefetchBatches:
+        print(dataloader.summary())
     dataloader = None
     print("Sleeping for 3 seconds to let dataloader subprocesses exit...")
-    ranks = torch.cat(ranks, 0)
-    rankMetrics = metrics.computeMetrics(ranks.cpu())
+    rankMetrics = rankAccumulator.computeMetrics()
+    if candidateHits:
+        candidateHits = torch.cat(candidateHits, 0).float()
+        rankMetrics['candidateRecall'] = candidateHits.mean().item()
+        if stageTimes[0] > 0:
+            rankMetrics['candidateSpeedup'] = stageTimes[1] / stageTimes[0]
+        print("Candidate recall@%d: %.4f, option scoring speedup: %.2fx" %
+              (numCandidates, rankMetrics['candidateRecall'],
+               rankMetrics.get('candidateSpeedup', 0)))
 
     # logProbsAll = [torch.cat(lprobs, 0).mean() for lprobs in logProbsAll]
     logProbsAll = [torch.cat([lprob.unsqueeze(0) for lprob in lprobs], 0).mean() for lprobs in logProbsAll if lprobs]
@@ -11,7 +11,7 @@ import torch.nn.functional as F
 import options
 import visdial.metrics as metrics
 from utils import utilities as utils
-from dataloader import VisDialDataset
+from dataloader import VisDialDataset, BucketBatchSampler, BatchPrefetcher
 from torch.utils.data import DataLoader
 
 from sklearn.metrics.pairwise import pairwise_distances
@@ -19,6 +19,18 @@ from sklearn.metrics.pairwise import pairwise_distances
 from six.moves import range
 
 
+def rankImages(predFeatures, gtFeatures):
+    '''
+    Rank of the ground truth image (i-th row of gtFeatures) among all
+    images in the split by distance to the i-th predicted feature.
+    '''
+    # num_examples x num_examples
+    dists = pairwise_distances(predFeatures, gtFeatures)
+    order = dists.argsort(axis=1)
+    ranks = (order == np.arange(dists.shape[0])[:, None]).argmax(1) + 1
+    return torch.from_numpy(ranks)
+
+
 def rankQBot(qBot, dataset, split, exampleLimit=None, verbose=0):
     '''
         Evaluates Q-Bot performance on image retrieval when it is shown
@@ -44,12 +56,24 @@ def rankQBot(qBot, dataset, split, exampleLimit=None, verbose=0):
     numBatches = (numExamples - 1) // batchSize + 1
     original_split = dataset.split
     dataset.split = split
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batchSize,
-        shuffle=True,
-        num_workers=0,
-        collate_fn=dataset.collate_fn)
+    if dataset.bucketBatches:
+        sampler = BucketBatchSampler(
+            dataset, batchSize, poolBatches=dataset.bucketBatches)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batchSize,
+            shuffle=True,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    if dataset.prefetchBatches:
+        dataloader = BatchPrefetcher(
+            dataloader, dataset.prefetchBatches, useGPU=dataset.useGPU)
 
     # enumerate all gt features and all predicted features
     gtImgFeatures = []
@@ -62,9 +86,10 @@ def rankQBot(qBot, dataset, split, exampleLimit=None, verbose=0):
         if idx == numBatches:
             break
 
+        # Sequence lengths stay on the CPU for packing plans
         if dataset.useGPU:
             batch = {
-                key: v.cuda()
+                key: v if key.endswith('_len') else v.cuda()
                 for key, v in batch.items() if hasattr(v, 'cuda')
             }
         else:
@@ -118,9 +143,12 @@ def rankQBot(qBot, dataset, split, exampleLimit=None, verbose=0):
         sys.stdout.write(progressString % (split, idx + 1, numBatches))
         sys.stdout.flush()
     sys.stdout.write("\n")
+    if dataset.prefetchBatches:
+        print(dataloader.summary())
 
     gtFeatures = torch.cat(gtImgFeatures, 0).data.cpu().numpy()
     rankMetricsRounds = []
+    rankAccumulator = metrics.RankAccumulator(numRounds + 1)
     poolSize = len(dataset)//4
 
     # Keeping tracking of feature regression loss and CE logprobs
@@ -159,15 +187,10 @@ def rankQBot(qBot, dataset, split, exampleLimit=None, verbose=0):
         predFeatures = torch.cat(roundwiseFeaturePreds[round],
                                  0).data.cpu().numpy()
         # num_examples x num_examples
-        dists = pairwise_distances(predFeatures, gtFeatures)
-        ranks = []
-        for i in range(dists.shape[0]):
-            rank = int(np.where(dists[i, :].argsort() == i)[0]) + 1
-            ranks.append(rank)
-        ranks = np.array(ranks)
-        rankMetrics = metrics.computeMetrics(Variable(torch.from_numpy(ranks)))
-        meanRank = ranks.mean()
-        se = ranks.std() / np.sqrt(poolSize)
+        rankAccumulator.update(rankImages(predFeatures, gtFeatures), round)
+        rankMetrics = rankAccumulator.computeMetrics(round)
+        meanRank = rankMetrics['mean']
+        se = rankAccumulator.rankStd(round) / np.sqrt(poolSize)
         meanPercRank = 100 * (1 - (meanRank / poolSize))
         percRankLow = 100 * (1 - ((meanRank + se) / poolSize))
         percRankHigh = 100 * (1 - ((meanRank - se) / poolSize))
@@ -233,12 +256,25 @@ def rankQABots(qBot, aBot, dataset, split, exampleLimit=None, beamSize=1):
     numBatches = (numExamples - 1) // batchSize + 1
     original_split = dataset.split
     dataset.split = split
-    dataloader = DataLoader(
-        dataset,
-        batch_size=batchSize,
-        shuffle=False,
-        num_workers=0,
-        collate_fn=dataset.collate_fn)
+    if dataset.bucketBatches:
+        sampler = BucketBatchSampler(
+            dataset, batchSize, poolBatches=dataset.bucketBatches,
+            shuffle=False)
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=batchSize,
+            shuffle=False,
+            num_workers=0,
+            collate_fn=dataset.collate_fn)
+    if dataset.prefetchBatches:
+        dataloader = BatchPrefetcher(
+            dataloader, dataset.prefetchBatches, useGPU=dataset.useGPU)
 
     gtImgFeatures = []
     roundwiseFeaturePreds = [[] for _ in range(numRounds + 1)]
@@ -248,9 +284,10 @@ def rankQABots(qBot, aBot, dataset, split, exampleLimit=None, beamSize=1):
         if idx == numBatches:
             break
 
+        # Sequence lengths stay on the CPU for packing plans
         if dataset.useGPU:
-            batch = {key: v.cuda() for key, v in batch.items() \
-                                            if hasattr(v, 'cuda')}
+            batch = {key: v if key.endswith('_len') else v.cuda() \
+                        for key, v in batch.items() if hasattr(v, 'cuda')}
         else:
             batch = {key: v.contiguous() for key, v in batch.items() \
                                             if hasattr(v, 'cuda')}
@@ -293,27 +330,22 @@ def rankQABots(qBot, aBot, dataset, split, exampleLimit=None, beamSize=1):
         sys.stdout.write(progressString % (split, idx + 1, numBatches))
         sys.stdout.flush()
     sys.stdout.write("\n")
+    if dataset.prefetchBatches:
+        print(dataloader.summary())
 
     gtFeatures = torch.cat(gtImgFeatures, 0).data.cpu().numpy()
     rankMetricsRounds = []
+    rankAccumulator = metrics.RankAccumulator(numRounds + 1)
 
     print("Percentile mean rank (round, mean, low, high)")
     for round in range(numRounds + 1):
         predFeatures = torch.cat(roundwiseFeaturePreds[round],
                                  0).data.cpu().numpy()
-        dists = pairwise_distances(predFeatures, gtFeatures)
-        # num_examples x num_examples
-        ranks = []
-        for i in range(dists.shape[0]):
-            # Computing rank of i-th prediction vs all images in split
-            rank = int(np.where(dists[i, :].argsort() == i)[0]) + 1
-            ranks.append(rank)
-        ranks = np.array(ranks)
-        rankMetrics = metrics.computeMetrics(Variable(torch.from_numpy(ranks)))
-        # assert len(ranks) == len(numExamples)
-        poolSize = len(ranks)
-        meanRank = ranks.mean()
-        se = ranks.std() / np.sqrt(poolSize)
+        rankAccumulator.update(rankImages(predFeatures, gtFeatures), round)
+        rankMetrics = rankAccumulator.computeMetrics(round)
+        poolSize = predFeatures.shape[0]
+        meanRank = rankMetrics['mean']
+        se = rankAccumulator.rankStd(round) / np.sqrt(poolSize)
         meanPercRank = 100 * (1 - (meanRank / poolSize))
         percRankLow = 100 * (1 - ((meanRank + se) / poolSize))
         percRankHigh = 100 * (1 - ((meanRank - se) / poolSize))
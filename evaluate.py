@@ -114,8 +114,11 @@ if __name__ == '__main__':
     # Evaluate A-Bot ranking
     if 'ABotRank' in params['evalModeList']:
         print("Performing ABotRank evaluation")
+        scoringFunction = None if params['fusedNll'] else utils.maskedNll
         rankMetrics = rankABot(
-            aBot, dataset, split, scoringFunction=utils.maskedNll)
+            aBot, dataset, split, scoringFunction=scoringFunction,
+            numCandidates=params['rankCandidates'],
+            optionMemory=params['optionMemory'])
         print("Performing ----------------------------")
         
         for metric, value in rankMetrics.items():
@@ -19,6 +19,27 @@ def readCommandLine(argv=None):
                             help='Directory for coco images, optional')
     parser.add_argument('-cocoInfo', default='',
                             help='JSON file with coco split information')
+    parser.add_argument('-lazyLoad', default=0, type=int,
+                            help='Read dataset arrays from disk on demand '
+                                    'instead of into memory. 1=yes, 0=no')
+    parser.add_argument('-cacheDir', default='',
+                            help='Directory for caching processed dataset '
+                                    'splits, disabled if empty')
+    parser.add_argument('-compactData', default=0, type=int,
+                            help='Store dataset tokens in the smallest integer '
+                                    'type that fits. 1=yes, 0=no')
+    parser.add_argument('-poolOptions', default=0, type=int,
+                            help='Batch answer options as indices into a '
+                                    'shared option pool. 1=yes, 0=no')
+    parser.add_argument('-shardDir', default='',
+                            help='Directory of dataset shards to stream the '
+                                    'train split from, disabled if empty')
+    parser.add_argument('-shardSize', default=1000, type=int,
+                            help='Number of dialogs per shard written to '
+                                    'shardDir')
+    parser.add_argument('-shuffleBuffer', default=1000, type=int,
+                            help='Number of dialogs in the shuffle buffer when '
+                                    'streaming shards')
 
     #-------------------------------------------------------------------------
     # Logging settings
@@ -60,6 +81,9 @@ def readCommandLine(argv=None):
                             help='Number of layers in LSTM')
     parser.add_argument('-imgNorm', default=1, type=int,
                             help='Normalize the image feature. 1=yes, 0=no')
+    parser.add_argument('-imgStorage', default='float32',
+                            help='Precision of image features held in memory',
+                            choices=['float32', 'float16', 'int8'])
 
     # A-Bot encoder + decoder
     parser.add_argument('-encoder', default='hre-ques-lateim-hist',
@@ -104,11 +128,48 @@ def readCommandLine(argv=None):
                             help='Freeze weights of Q-bot feature network')
     parser.add_argument('-rlAbotReward', default=1, type=int,
                             help='Choose whether RL reward goes to A-Bot')
+    parser.add_argument('-dialogForward', default=0, type=int,
+                            help='Decode all teacher forced rounds of a dialog '
+                                    'in a single decoder pass. 1=yes, 0=no')
+    parser.add_argument('-fusedNll', default=0, type=int,
+                            help='Compute NLL losses and answer option scores '
+                                    'without materializing log-probabilities '
+                                    'over the vocabulary, scoring options '
+                                    'over a trie of shared prefixes. '
+                                    '1=yes, 0=no')
+    parser.add_argument('-rankCandidates', default=0, type=int,
+                            help='Number of answer options kept by a cheap '
+                                    'first stage scorer when ranking A-Bot '
+                                    'options, only these are scored by the '
+                                    'decoder. 0 scores all options')
+    parser.add_argument('-optionMemory', default=0, type=int,
+                            help='Memory budget in MB for scoring the answer '
+                                    'options of a batch in A-Bot ranking, '
+                                    'options are scored in chunks that fit. '
+                                    '0 scores all options at once')
 
     # Other training environmnet settings
     parser.add_argument('-useGPU', action='store_true', help='Use GPU or CPU')
     parser.add_argument('-numWorkers', default=2, type=int,
                             help='Number of worker threads in dataloader')
+    parser.add_argument('-sharedMemory', default=0, type=int,
+                            help='Share dataset tensors with dataloader '
+                                    'workers instead of copying. 1=yes, 0=no')
+    parser.add_argument('-bucketBatches', default=0, type=int,
+                            help='Group dialogs of similar length into batches, '
+                                    'sorting pools of this many batches. '
+                                    '0 disables bucketing')
+    parser.add_argument('-blockShuffle', default=0, type=int,
+                            help='Shuffle training dialogs in contiguous blocks '
+                                    'of this size to keep disk reads mostly '
+                                    'sequential. 0 disables block shuffling')
+    parser.add_argument('-shuffleWindow', default=4, type=int,
+                            help='Number of consecutive blocks whose dialogs are '
+                                    'shuffled together with -blockShuffle')
+    parser.add_argument('-prefetchBatches', default=0, type=int,
+                            help='Number of collated batches staged ahead on '
+                                    'the target device by a background thread. '
+                                    '0 disables prefetching')
 
     #-------------------------------------------------------------------------
     # Evaluation params
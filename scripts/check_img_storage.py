@@ -0,0 +1,78 @@
+'''
+Check that reduced precision image feature storage (-imgStorage float16 or
+int8) leaves A-Bot and Q-Bot ranking accuracy unchanged. The same bots rank
+the val split with float32, float16 and int8 features, with the same seeds,
+and the metrics are compared against float32.
+
+Takes the options of evaluate.py. Bots are loaded from -startFrom and
+-qstartFrom if given, otherwise they are randomly initialized. Example:
+
+    python scripts/check_img_storage.py -inputImg data/visdial/data_img.h5 \
+        -startFrom checkpoints/abot_sl.vd -qstartFrom checkpoints/qbot_sl.vd \
+        -exampleLimit 1000
+'''
+import os
+import sys
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import options
+from dataloader import VisDialDataset
+from eval_utils.rank_answerer import rankABot
+from eval_utils.rank_questioner import rankQBot
+from utils import utilities as utils
+
+storageTypes = ['float32', 'float16', 'int8']
+
+
+def loadBot(params, agent):
+    startArg = 'startFrom' if agent == 'abot' else 'qstartFrom'
+    if params[startArg]:
+        bot, _, _ = utils.loadModel(
+            params, agent, overwrite=False, map_location=torch.device('cpu'))
+    else:
+        torch.manual_seed(0)
+        bot, _, _ = utils.loadModel(params, agent)
+    bot.eval()
+    return bot
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-exampleLimit', default=0, type=int,
+                        help='Data points of the val split to rank, 0 for all')
+    args, argv = parser.parse_known_args()
+    params = options.readCommandLine(argv)
+    exampleLimit = args.exampleLimit or None
+
+    aBot, qBot = None, None
+    results = {}
+    for imgStorage in storageTypes:
+        dlparams = params.copy()
+        dlparams['imgStorage'] = imgStorage
+        dataset = VisDialDataset(dlparams, ['val'])
+        if aBot is None:
+            for key in ['vocabSize', 'numOptions', 'numRounds']:
+                if hasattr(dataset, key):
+                    params[key] = getattr(dataset, key)
+            aBot = loadBot(params, 'abot')
+            qBot = loadBot(params, 'qbot')
+
+        torch.manual_seed(1)
+        aMetrics = rankABot(aBot, dataset, 'val', utils.maskedNll,
+                            exampleLimit=exampleLimit)
+        torch.manual_seed(1)
+        qMetrics, _ = rankQBot(qBot, dataset, 'val',
+                               exampleLimit=exampleLimit)
+        results[imgStorage] = {'ABot': aMetrics, 'QBot': qMetrics}
+
+    print('\n%-6s %-12s %12s %12s %12s' %
+          ('bot', 'metric', 'float32', 'float16', 'int8'))
+    for bot in ['ABot', 'QBot']:
+        for metric in ['r1', 'r5', 'r10', 'mean', 'mrr']:
+            values = [float(results[imgStorage][bot][metric])
+                      for imgStorage in storageTypes]
+            print('%-6s %-12s %12.4f %12.4f %12.4f' %
+                  tuple([bot, metric] + values))
@@ -0,0 +1,95 @@
+'''
+Equivalence of VisDialDataset.addStartEnd with the per-row loop it
+replaced. Run as a script for the micro-benchmark:
+
+    python tests/test_add_start_end.py [numDialogs]
+'''
+import io
+import os
+import sys
+import contextlib
+from timeit import default_timer as timer
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import VisDialDataset
+
+START, END = 98, 99
+
+
+def addStartEndLoop(seq, seqLen, startToken, endToken):
+    '''Reference copy of the per-row loop (without empty warnings)'''
+    size = list(seq.size())
+    maxLen = size[-1]
+    seq = seq.contiguous().view(-1, maxLen)
+    seqLen = seqLen.contiguous().view(-1)
+
+    sequence = torch.LongTensor(seq.size(0), maxLen + 2).fill_(0)
+    # decodeIn begins with <START>
+    sequence[:, 0] = startToken
+
+    for seqId in range(seq.size(0)):
+        length = seqLen[seqId]
+        if length == 0:
+            continue
+
+        sequence[seqId, 1:length + 1] = seq[seqId, :length]
+        sequence[seqId, length + 1] = endToken
+
+    return sequence.view(size[:-1] + [maxLen + 2])
+
+
+def makeDataset():
+    dataset = VisDialDataset.__new__(VisDialDataset)
+    dataset.startToken = START
+    dataset.endToken = END
+    return dataset
+
+
+def randomSequences(size, maxLen, minLen=0):
+    '''Right padded random tokens, tokens past the length are not zeroed'''
+    seqLen = torch.randint(minLen, maxLen + 1, size)
+    seq = torch.randint(1, START, tuple(size) + (maxLen,))
+    return seq, seqLen
+
+
+def test_matches_loop():
+    torch.manual_seed(0)
+    dataset = makeDataset()
+    for size, dtype in [((50, 10), torch.int64), ((7,), torch.int32),
+                        ((3, 4, 5), torch.int16)]:
+        seq, seqLen = randomSequences(size, 12)
+        seq, seqLen = seq.to(dtype), seqLen.to(dtype)
+        expected = addStartEndLoop(seq, seqLen, START, END)
+        output = dataset.addStartEnd(seq, seqLen, 'ques')
+        assert output.dtype == torch.int64
+        assert torch.equal(output, expected)
+
+
+def test_empty_sequences():
+    dataset = makeDataset()
+    seq = torch.tensor([[5, 6, 7], [8, 9, 1]])
+    output = dataset.addStartEnd(seq, torch.tensor([0, 3]), 'ans')
+    assert output.tolist() == [[START, 0, 0, 0, 0], [START, 8, 9, 1, END]]
+
+
+if __name__ == '__main__':
+    numDialogs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    torch.manual_seed(0)
+    dataset = makeDataset()
+    seq, seqLen = randomSequences((numDialogs, 10), 20)
+    print('Question split of %d x 10 x 20 tokens, lengths 0-20' % numDialogs)
+
+    start = timer()
+    expected = addStartEndLoop(seq, seqLen, START, END)
+    loopTime = timer() - start
+    print('old loop   %.2fs' % loopTime)
+
+    start = timer()
+    # Skip the warnings printed for empty sequences
+    with contextlib.redirect_stdout(io.StringIO()):
+        output = dataset.addStartEnd(seq, seqLen, 'ques')
+    vectorTime = timer() - start
+    print('vectorized %.2fs (%.0fx), identical: %s' %
+          (vectorTime, loopTime / vectorTime, torch.equal(output, expected)))
@@ -0,0 +1,78 @@
+'''
+Batched Decoder.beamSearchDecoder against a beam search over Python
+lists of beams, one batch element at a time.
+'''
+import pytest
+import torch
+import torch.nn as nn
+
+from visdial.models.decoders.gen import Decoder
+
+VOCAB, START, END = 20, 18, 19
+
+
+def beamSearchRow(decoder, initStates, beamSize, maxSeqLen):
+    '''
+    Reference search for a single batch element. Beams are ranked by the
+    mean log probability of their tokens; ended beams keep their score and
+    are only extended by <END>. Returns the beams (with <START>), best
+    first.
+    '''
+    def step(token, states):
+        emb = decoder.wordEmbed(torch.tensor([[token]]))
+        output, states = decoder.rnn(emb, states)
+        return decoder.logSoftmax(decoder.outNet(output[:, 0]))[0], states
+
+    logProbs, states = step(START, initStates)
+    topScores, topTokens = logProbs.topk(beamSize)
+    beams = [(score, [token], states)
+             for score, token in zip(topScores, topTokens.tolist())]
+    for t in range(1, maxSeqLen):
+        if all(tokens[-1] == END for _, tokens, _ in beams):
+            break
+        candidates = []
+        for score, tokens, states in beams:
+            if tokens[-1] == END:
+                candidates.append((score, tokens + [END], states))
+                continue
+            logProbs, nextStates = step(tokens[-1], states)
+            # Running mean over t + 1 tokens
+            scores = logProbs * (1.0 / (t + 1)) + score * (t / (t + 1))
+            candidates.extend((score, tokens + [token], nextStates)
+                              for token, score in enumerate(scores))
+        candidates.sort(key=lambda candidate: -candidate[0].item())
+        beams = candidates[:beamSize]
+    return [[START] + tokens for _, tokens, _ in beams]
+
+
+@pytest.mark.parametrize('beamSize', [1, 3, 5])
+def test_matches_per_row_search(beamSize):
+    torch.manual_seed(0)
+    decoder = Decoder(VOCAB, 8, 16, 2, START, END)
+    decoder.wordEmbed = nn.Embedding(VOCAB, 8, padding_idx=0)
+    # End beams early enough for ended and alive beams to compete
+    decoder.outNet.bias.data[END] += 0.1
+    decoder.eval()
+    batchSize, maxSeqLen = 6, 8
+    initStates = tuple(torch.randn(2, batchSize, 16) for _ in range(2))
+
+    with torch.no_grad():
+        tokens, seqLens = decoder.beamSearchDecoder(
+            initStates, beamSize, maxSeqLen, nBest=beamSize)
+        if beamSize > 1:
+            topTokens, topLens = decoder.beamSearchDecoder(
+                initStates, beamSize, maxSeqLen)
+            assert torch.equal(topTokens, tokens[:, 0])
+            assert torch.equal(topLens, seqLens[:, 0])
+        else:
+            tokens, seqLens = tokens.unsqueeze(1), seqLens.unsqueeze(1)
+
+        for row in range(batchSize):
+            states = tuple(x[:, row:row + 1] for x in initStates)
+            beams = beamSearchRow(decoder, states, beamSize, maxSeqLen)
+            for beam, expected in enumerate(beams):
+                length = len(expected)
+                assert tokens[row, beam, :length].tolist() == expected
+                assert tokens[row, beam, length:].eq(END).all()
+                assert seqLens[row, beam] == \
+                    sum(token != END for token in expected)
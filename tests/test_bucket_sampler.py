@@ -0,0 +1,38 @@
+import torch
+
+from dataloader import BucketBatchSampler
+
+
+class FakeDataset(object):
+    '''Length profiles of random dialogs, as read by BucketBatchSampler'''
+    numRounds = 10
+    split = 'train'
+
+    def __init__(self, numDataPoints):
+        self.lengths = torch.randint(1, 20, (numDataPoints, 3))
+
+    def getLengthProfile(self, dtype):
+        return self.lengths
+
+
+def makeSampler(dataset, seed):
+    return BucketBatchSampler(dataset, 8, poolBatches=4, dropLast=True,
+                              seed=seed)
+
+
+def test_resumed_epochs_match():
+    torch.manual_seed(0)
+    dataset = FakeDataset(203)
+    sampler = makeSampler(dataset, seed=3)
+    epochs = [list(sampler) for _ in range(3)]
+    assert epochs[0] != epochs[1] and epochs[1] != epochs[2]
+    for epoch in epochs:
+        assert len(epoch) == len(sampler) == 203 // 8
+        indices = [index for batch in epoch for index in batch]
+        assert len(set(indices)) == len(indices)
+
+    # A new sampler (e.g. after -continue) replays the batches of an epoch
+    for epochId in [2, 1]:
+        resumed = makeSampler(dataset, seed=3)
+        resumed.setEpoch(epochId)
+        assert list(resumed) == epochs[epochId]
@@ -0,0 +1,117 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from utils import utilities as utils
+
+
+def concatPaddedSequencesLoop(seq1, seqLens1, seq2, seqLens2,
+                              padding='right'):
+    '''
+    Reference copy of the per-row concatPaddedSequences loop replaced by
+    the vectorized version (warnings and the padding check removed).
+    '''
+    concat_list = []
+    cat_seq = torch.cat([seq1, seq2], dim=1)
+    maxLen1 = seq1.size(1)
+    maxLen2 = seq2.size(1)
+    maxCatLen = cat_seq.size(1)
+    batchSize = seq1.size(0)
+    for b_idx in range(batchSize):
+        len_1 = seqLens1[b_idx].item()
+        len_2 = seqLens2[b_idx].item()
+        cat_len_ = len_1 + len_2
+        if cat_len_ == 0:
+            raise RuntimeError("Both input sequences are empty")
+
+        elif padding == 'left':
+            pad_len_1 = maxLen1 - len_1
+            pad_len_2 = maxLen2 - len_2
+            if len_1 == 0:
+                cat_ = seq2[b_idx][pad_len_2:]
+            elif len_2 == 0:
+                cat_ = seq1[b_idx][pad_len_1:]
+            else:
+                cat_ = torch.cat([seq1[b_idx][pad_len_1:],
+                                  seq2[b_idx][pad_len_2:]], 0)
+            cat_padded = F.pad(
+                input=cat_,  # Left pad
+                pad=((maxCatLen - cat_len_), 0),
+                mode="constant",
+                value=0)
+        elif padding == 'right':
+            if len_1 == 0:
+                cat_ = seq2[b_idx][:len_1]
+            elif len_2 == 0:
+                cat_ = seq1[b_idx][:len_1]
+            else:
+                cat_ = torch.cat([seq1[b_idx][:len_1],
+                                  seq2[b_idx][:len_2]], 0)
+            cat_padded = F.pad(
+                input=cat_,  # Right pad
+                pad=(0, (maxCatLen - cat_len_)),
+                mode="constant",
+                value=0)
+        concat_list.append(cat_padded.unsqueeze(0))
+    concat_output = torch.cat(concat_list, 0)
+    return concat_output
+
+
+def paddedSequences(seqLens, maxLen, padding):
+    '''Random tokens (1-99) padded with 0 to maxLen on the given side'''
+    seq = torch.zeros(len(seqLens), maxLen, dtype=torch.long)
+    for b_idx, seqLen in enumerate(seqLens.tolist()):
+        tokens = torch.randint(1, 100, (seqLen,))
+        if padding == 'right':
+            seq[b_idx, :seqLen] = tokens
+        else:
+            seq[b_idx, maxLen - seqLen:] = tokens
+    return seq
+
+
+@pytest.mark.parametrize('padding', ['left', 'right'])
+@pytest.mark.parametrize('allowEmpty', [False, True])
+def test_matches_loop(padding, allowEmpty):
+    torch.manual_seed(0)
+    for _ in range(200):
+        batchSize = torch.randint(1, 12, (1,)).item()
+        maxLen1, maxLen2 = torch.randint(1, 25, (2,)).tolist()
+        minLen = 0 if allowEmpty else 1
+        seqLens1 = torch.randint(minLen, maxLen1 + 1, (batchSize,))
+        seqLens2 = torch.randint(minLen, maxLen2 + 1, (batchSize,))
+        # Both sequences empty is an error
+        seqLens2[(seqLens1 + seqLens2).eq(0)] = 1
+        if padding == 'right':
+            # See test_right_padding_empty_first
+            seqLens1.clamp_(min=1)
+        seq1 = paddedSequences(seqLens1, maxLen1, padding)
+        seq2 = paddedSequences(seqLens2, maxLen2, padding)
+
+        expected = concatPaddedSequencesLoop(
+            seq1, seqLens1, seq2, seqLens2, padding)
+        output = utils.concatPaddedSequences(
+            seq1, seqLens1, seq2, seqLens2, padding)
+        assert torch.equal(output, expected)
+
+
+def test_right_padding_empty_first():
+    # Intentional divergence: the loop sliced seq2 with the length of seq1
+    # here, giving a row of the wrong size (and failing for batches with
+    # other rows). The output is now seq2 followed by padding.
+    seq1 = torch.tensor([[0, 0], [5, 6]])
+    seq2 = torch.tensor([[7, 8, 0], [9, 0, 0]])
+    output = utils.concatPaddedSequences(
+        seq1, torch.tensor([0, 2]), seq2, torch.tensor([2, 1]), 'right')
+    assert output.tolist() == [[7, 8, 0, 0, 0], [5, 6, 9, 0, 0]]
+    with pytest.raises(RuntimeError):
+        concatPaddedSequencesLoop(
+            seq1, torch.tensor([0, 2]), seq2, torch.tensor([2, 1]), 'right')
+
+
+def test_errors():
+    seq = torch.zeros(1, 3, dtype=torch.long)
+    empty = torch.tensor([0])
+    with pytest.raises(RuntimeError):
+        utils.concatPaddedSequences(seq, empty, seq, empty)
+    with pytest.raises(ValueError):
+        utils.concatPaddedSequences(seq, empty + 1, seq, empty + 1, 'middle')
@@ -0,0 +1,55 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from utils import utilities as utils
+from visdial.models.decoders.gen import Decoder
+
+VOCAB, START, END = 30, 28, 29
+
+
+def randomSequences(batchSize, maxWords):
+    '''Right padded [<START>, words, <END>] sequences'''
+    numWords = torch.randint(0, maxWords + 1, (batchSize,))
+    seq = torch.randint(1, START, (batchSize, maxWords + 2))
+    seq[:, 0] = START
+    position = torch.arange(maxWords + 2)
+    seq[position > numWords.unsqueeze(1) + 1] = 0
+    seq.scatter_(1, numWords.unsqueeze(1) + 1, END)
+    return seq
+
+
+@pytest.mark.parametrize('returnScores', [False, True])
+@pytest.mark.parametrize('chunkSize', [1024, 7])
+def test_matches_masked_nll(returnScores, chunkSize):
+    torch.manual_seed(0)
+    outNet = nn.Linear(16, VOCAB)
+    outputs = torch.randn(9, 8, 16, requires_grad=True)
+    gtSeq = randomSequences(9, 6)
+
+    expected = utils.maskedNll(torch.log_softmax(outNet(outputs), 2), gtSeq,
+                               returnScores)
+    expectedGrads = torch.autograd.grad(
+        expected.sum(), [outputs, outNet.weight, outNet.bias])
+    fused = utils.fusedMaskedNll(outputs, outNet, gtSeq, returnScores,
+                                 chunkSize=chunkSize)
+    grads = torch.autograd.grad(
+        fused.sum(), [outputs, outNet.weight, outNet.bias])
+
+    assert torch.allclose(fused, expected, atol=1e-5)
+    for grad, expectedGrad in zip(grads, expectedGrads):
+        assert torch.allclose(grad, expectedGrad, atol=1e-5)
+
+
+def test_decoder_forward_nll():
+    torch.manual_seed(0)
+    decoder = Decoder(VOCAB, 8, 16, 2, START, END)
+    decoder.wordEmbed = nn.Embedding(VOCAB, 8, padding_idx=0)
+    decoder.eval()
+    encStates = tuple(torch.randn(2, 9, 16) for _ in range(2))
+    gtSeq = randomSequences(9, 6)
+    logProbs = decoder.forward(encStates, gtSeq)
+    for returnScores in [False, True]:
+        assert torch.allclose(
+            decoder.forwardNll(encStates, gtSeq, returnScores),
+            utils.maskedNll(logProbs, gtSeq, returnScores), atol=1e-5)
@@ -0,0 +1,101 @@
+'''
+Option scoring paths of Decoder.evalOptions against dense teacher forced
+scoring of every option with utils.maskedNll.
+'''
+import pytest
+import torch
+import torch.nn as nn
+
+from utils import utilities as utils
+from visdial.models.decoders.gen import Decoder
+
+VOCAB, START, END = 40, 38, 39
+
+
+def makeDecoder():
+    torch.manual_seed(0)
+    decoder = Decoder(VOCAB, 8, 16, 2, START, END)
+    decoder.wordEmbed = nn.Embedding(VOCAB, 8, padding_idx=0)
+    return decoder.eval()
+
+
+def randomOptions(batchSize, numOptions, maxWords):
+    '''
+    Right padded [<START>, words, <END>] options and their lengths (with
+    <START>, without <END>). The first words come from a few tokens only,
+    so options of a batch element share prefixes.
+    '''
+    numWords = torch.randint(1, maxWords + 1, (batchSize, numOptions))
+    words = torch.randint(1, START, (batchSize, numOptions, maxWords))
+    words[:, :, :2] = torch.randint(1, 4, (batchSize, numOptions, 2))
+    position = torch.arange(maxWords)
+    words[position >= numWords.unsqueeze(2)] = 0
+    options = torch.zeros(batchSize, numOptions, maxWords + 2,
+                          dtype=torch.long)
+    options[:, :, 0] = START
+    options[:, :, 1:-1] = words
+    options.scatter_(2, numWords.unsqueeze(2) + 1, END)
+    return options, numWords + 1
+
+
+def randomStates(decoder, batchSize):
+    return tuple(torch.randn(decoder.numLayers, batchSize,
+                             decoder.rnnHiddenSize) for _ in range(2))
+
+
+def denseScores(decoder, encStates, options):
+    '''Reference: forward every option over its full padded length'''
+    batchSize, numOptions, maxLen = options.size()
+    optionsFlat = options.view(-1, maxLen)
+    states = [x.repeat_interleave(numOptions, 1) for x in encStates]
+    logProbs = decoder.forward(states, optionsFlat)
+    scores = utils.maskedNll(logProbs, optionsFlat, returnScores=True)
+    return scores.view(batchSize, numOptions)
+
+
+def test_packed_log_probs():
+    decoder = makeDecoder()
+    options, optionLens = randomOptions(6, 1, 7)
+    options, optionLens = options.squeeze(1), optionLens.squeeze(1)
+    encStates = randomStates(decoder, 6)
+    with torch.no_grad():
+        dense = decoder.forward(encStates, options)
+        packed = decoder.forwardPacked(encStates, options, optionLens)
+    inSeq = torch.arange(options.size(1)) < optionLens.unsqueeze(1)
+    assert torch.allclose(packed[inSeq], dense[inSeq], atol=1e-5)
+    assert packed[~inSeq].eq(0).all()
+
+
+@pytest.mark.parametrize('scoringFunction', [utils.maskedNll, None])
+@pytest.mark.parametrize('memoryBudget', [0, 0.01, 0.4])
+def test_matches_dense(scoringFunction, memoryBudget):
+    decoder = makeDecoder()
+    options, optionLens = randomOptions(5, 20, 6)
+    encStates = randomStates(decoder, 5)
+    with torch.no_grad():
+        expected = denseScores(decoder, encStates, options)
+        scores = decoder.evalOptions(encStates, options, optionLens,
+                                     scoringFunction,
+                                     memoryBudget=memoryBudget)
+    assert torch.allclose(scores, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('scoringFunction', [utils.maskedNll, None])
+def test_candidates(scoringFunction):
+    decoder = makeDecoder()
+    options, optionLens = randomOptions(5, 20, 6)
+    encStates = randomStates(decoder, 5)
+    with torch.no_grad():
+        expected = denseScores(decoder, encStates, options)
+        scores = decoder.evalOptions(encStates, options, optionLens,
+                                     scoringFunction, numCandidates=8)
+    candidates = decoder.optionCandidates
+    assert candidates.size() == (5, 8)
+    candidateScores = scores.gather(1, candidates)
+    assert torch.allclose(candidateScores, expected.gather(1, candidates),
+                          atol=1e-5)
+    # Pruned options rank below every candidate
+    pruned = torch.ones_like(scores, dtype=torch.bool).scatter(
+        1, candidates, False)
+    lowest = candidateScores.min(1, keepdim=True)[0].expand_as(scores)
+    assert (scores[pruned] < lowest[pruned]).all()
@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from visdial import metrics
+
+
+def referenceMetrics(ranks):
+    '''Metrics computed from all ranks at once'''
+    ranks = ranks.double()
+    return {
+        'r1': 100 * ranks.eq(1).double().mean().item(),
+        'r5': 100 * ranks.le(5).double().mean().item(),
+        'r10': 100 * ranks.le(10).double().mean().item(),
+        'mean': ranks.mean().item(),
+        'mrr': ranks.reciprocal().mean().item(),
+    }
+
+
+def assertMetricsEqual(results, expected):
+    assert sorted(results) == sorted(expected)
+    for metric in expected:
+        assert results[metric] == pytest.approx(expected[metric])
+
+
+def test_merge_matches_single_accumulator():
+    torch.manual_seed(0)
+    numRounds = 3
+    ranks = torch.randint(1, 101, (40, numRounds))
+    merged = metrics.RankAccumulator(numRounds)
+    for part in ranks.split(12):
+        accumulator = metrics.RankAccumulator(numRounds)
+        for round in range(numRounds):
+            accumulator.update(part[:, round], round)
+        merged.merge(accumulator)
+
+    assertMetricsEqual(merged.computeMetrics(), referenceMetrics(ranks))
+    for round in range(numRounds):
+        assertMetricsEqual(merged.computeMetrics(round),
+                           referenceMetrics(ranks[:, round]))
+        assert merged.rankStd(round) == pytest.approx(
+            ranks[:, round].double().std(unbiased=False).item())
+    assert merged.rankStd() == pytest.approx(
+        ranks.double().std(unbiased=False).item())
+
+
+def test_merge_rounds_must_match():
+    with pytest.raises(AssertionError):
+        metrics.RankAccumulator(2).merge(metrics.RankAccumulator(3))
+
+
+def test_compute_metrics():
+    ranks = torch.tensor([1, 3, 7, 12, 100])
+    assertMetricsEqual(metrics.computeMetrics(ranks), referenceMetrics(ranks))
+    assert metrics.computeMetrics(ranks)['mrr'] == pytest.approx(
+        (1 + 1 / 3. + 1 / 7. + 1 / 12. + 1 / 100.) / 5)
@@ -0,0 +1,56 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from dataloader import VisDialShards
+
+
+def writeFakeShards(shardDir, numDataPoints, shardSize):
+    '''Shards in the layout of VisDialDataset.writeShards'''
+    shards = []
+    for start in range(0, numDataPoints, shardSize):
+        end = min(start + shardSize, numDataPoints)
+        shard = 'train_%05d' % len(shards)
+        shardPath = os.path.join(shardDir, shard)
+        os.makedirs(shardPath)
+        arrays = {
+            'index': np.arange(start, end),
+            'img_feat': np.random.rand(end - start, 4).astype('float32'),
+        }
+        for key, value in arrays.items():
+            np.save(os.path.join(shardPath, key + '.npy'), value)
+        with open(os.path.join(shardPath, 'info.json'), 'w') as fileId:
+            json.dump({'keys': sorted(arrays)}, fileId)
+        shards.append(shard)
+    info = {'shards': shards, 'numDataPoints': numDataPoints}
+    with open(VisDialShards.manifestPath(shardDir, 'train'), 'w') as fileId:
+        json.dump(info, fileId)
+
+
+@pytest.mark.parametrize('numWorkers', [0, 2, 3])
+@pytest.mark.parametrize('shuffleBuffer', [1, 16])
+def test_batches_per_epoch(tmpdir, numWorkers, shuffleBuffer):
+    numDataPoints, batchSize = 67, 8
+    writeFakeShards(str(tmpdir), numDataPoints, shardSize=10)
+    shards = VisDialShards(str(tmpdir), 'train', shuffleBuffer=shuffleBuffer,
+                           batchSize=batchSize)
+    for dropLast in [True, False]:
+        dataloader = DataLoader(
+            shards,
+            batch_size=batchSize,
+            num_workers=numWorkers,
+            drop_last=dropLast,
+            collate_fn=shards.collate_fn)
+        batches = [batch['index'] for batch in dataloader]
+        assert len(batches) == len(dataloader)
+        indices = sorted(index for batch in batches for index in batch)
+        if dropLast:
+            assert len(batches) == numDataPoints // batchSize
+            assert all(len(batch) == batchSize for batch in batches)
+            assert len(set(indices)) == len(indices)
+        else:
+            assert indices == list(range(numDataPoints))
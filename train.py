@@ -13,7 +13,9 @@ import torch.optim as optim
 from torch.autograd import Variable
 
 import options
-from dataloader import VisDialDataset
+from dataloader import VisDialDataset, VisDialShards
+from dataloader import BucketBatchSampler, BlockShuffleSampler
+from dataloader import BatchPrefetcher
 from torch.utils.data import DataLoader
 from eval_utils.rank_answerer import rankABot
 from eval_utils.rank_questioner import rankQBot
@@ -87,16 +89,72 @@ if __name__ == '__main__':
         # Filtering parameters which require a gradient update
         parameters.extend(filter(lambda p: p.requires_grad, qBot.parameters()))
 
-    # Setup pytorch dataloader
-    dataset.split = 'train'
-    dataloader = DataLoader(
-        dataset,
-        batch_size=params['batchSize'],
-        shuffle=False,
-        num_workers=params['numWorkers'],
-        drop_last=True,
-        collate_fn=dataset.collate_fn,
-        pin_memory=False)
+    # Setup pytorch dataloader. With shards, the train split is streamed
+    # from disk and never loaded, the dataset only serves validation splits
+    dataset.split = 'val' if params['shardDir'] else 'train'
+    numIterPerEpoch = dataset.numDataPoints['train'] // params['batchSize']
+    if params['shardDir']:
+        # Stream the train split from shards, written on first use
+        dataset.writeShards('train', params['shardDir'], params['shardSize'])
+        shards = VisDialShards(
+            params['shardDir'],
+            'train',
+            shuffleBuffer=params['shuffleBuffer'],
+            seed=params['randomSeed'],
+            batchSize=params['batchSize'])
+        dataloader = DataLoader(
+            shards,
+            batch_size=params['batchSize'],
+            num_workers=params['numWorkers'],
+            drop_last=True,
+            collate_fn=shards.collate_fn,
+            pin_memory=False)
+        # Batches of one epoch, as produced by the sharded dataloader
+        numIterPerEpoch = len(dataloader)
+    elif params['bucketBatches']:
+        sampler = BucketBatchSampler(
+            dataset,
+            params['batchSize'],
+            poolBatches=params['bucketBatches'],
+            dropLast=True,
+            seed=params['randomSeed'])
+        print(sampler.summary())
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=sampler,
+            num_workers=params['numWorkers'],
+            collate_fn=dataset.collate_fn,
+            pin_memory=False)
+    elif params['blockShuffle']:
+        # Resume the shuffled order of a checkpoint at its next iteration
+        resumeIterID = params['ckpt_iterid'] + 1 if params['continue'] else 0
+        sampler = BlockShuffleSampler(
+            dataset.numDataPoints['train'],
+            params['blockShuffle'],
+            windowBlocks=params['shuffleWindow'],
+            seed=params['randomSeed'],
+            epoch=resumeIterID // numIterPerEpoch,
+            start=(resumeIterID % numIterPerEpoch) * params['batchSize'])
+        dataloader = DataLoader(
+            dataset,
+            batch_size=params['batchSize'],
+            sampler=sampler,
+            num_workers=params['numWorkers'],
+            drop_last=True,
+            collate_fn=dataset.collate_fn,
+            pin_memory=False)
+    else:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=params['batchSize'],
+            shuffle=False,
+            num_workers=params['numWorkers'],
+            drop_last=True,
+            collate_fn=dataset.collate_fn,
+            pin_memory=False)
+    if params['prefetchBatches']:
+        dataloader = BatchPrefetcher(
+            dataloader, params['prefetchBatches'], useGPU=params['useGPU'])
 
     # Initializing visdom environment for plotting data
     # viz = VisdomVisualize(
@@ -125,8 +183,9 @@ if __name__ == '__main__':
     runningLoss = None
 
     mse_criterion = nn.MSELoss(reduce=False)
+    # Answer option scoring for A-Bot validation, None selects fused scoring
+    scoringFunction = None if params['fusedNll'] else utils.maskedNll
 
-    numIterPerEpoch = dataset.numDataPoints['train'] // params['batchSize']
     print('\n%d iter per epoch.' % numIterPerEpoch)
 
     if params['useCurriculum']:
@@ -143,22 +202,32 @@ if __name__ == '__main__':
 
 
     def batch_iter(dataloader):
+        iterCount = 0
         for epochId in range(params['numEpochs']):
-            for idx, batch in enumerate(dataloader):
-                yield epochId, idx, batch
+            # Seed the order of a resumed epoch as in the original run
+            if params['shardDir']:
+                dataloader.dataset.setEpoch(
+                    startIterID // numIterPerEpoch + epochId)
+            elif params['bucketBatches']:
+                sampler.setEpoch(startIterID // numIterPerEpoch + epochId)
+            for batch in dataloader:
+                yield epochId, iterCount, batch
+                iterCount += 1
 
 
     start_t = timer()
-    for epochId, idx, batch in batch_iter(dataloader):
+    for epochId, iterCount, batch in batch_iter(dataloader):
         # Keeping track of iterId and epoch
-        iterId = startIterID + idx + (epochId * numIterPerEpoch)
+        iterId = startIterID + iterCount
         epoch = iterId // numIterPerEpoch
         gc.collect()
 
         # Moving current batch to GPU, if available
+        # Sequence lengths stay on the CPU for packing plans
         if dataset.useGPU:
             batch = {key: v.cuda() if hasattr(v, 'cuda') \
-                                        else v for key, v in batch.items()}
+                        and not key.endswith('_len') \
+                        else v for key, v in batch.items()}
 
         image = Variable(batch['img_feat'], requires_grad=False)
         caption = Variable(batch['cap'], requires_grad=False)
@@ -167,7 +236,6 @@ if __name__ == '__main__':
         gtQuesLens = Variable(batch['ques_len'], requires_grad=False)
         gtAnswers = Variable(batch['ans'], requires_grad=False)
         gtAnsLens = Variable(batch['ans_len'], requires_grad=False)
-        options = Variable(batch['opt'], requires_grad=False)
         optionLens = Variable(batch['opt_len'], requires_grad=False)
         gtAnsId = Variable(batch['ans_id'], requires_grad=False)
 
@@ -200,6 +268,42 @@ if __name__ == '__main__':
             featLoss += torch.mean(prevFeatDist)
             prevFeatDist = torch.mean(prevFeatDist,1)
 
+        # Teacher forced rounds of the whole dialog (all rounds in SL modes,
+        # rounds before rlRound in RL) decoded in a single pass per bot
+        dialogRounds = 0
+        if params['dialogForward']:
+            dialogRounds = numRounds
+            if params['trainMode'] == 'rl-full-QAf':
+                dialogRounds = min(rlRound, numRounds)
+        if dialogRounds > 0:
+            slBots = []
+            if params['trainMode'] in ['sl-abot', 'rl-full-QAf']:
+                slBots.append(aBot)
+            if params['trainMode'] in ['sl-qbot', 'rl-full-QAf']:
+                slBots.append(qBot)
+            for round in range(dialogRounds):
+                for bot in slBots:
+                    bot.observe(
+                        round,
+                        ques=gtQuestions[:, round],
+                        quesLens=gtQuesLens[:, round])
+                    bot.observe(
+                        round,
+                        ans=gtAnswers[:, round],
+                        ansLens=gtAnsLens[:, round])
+            if aBot in slBots and params['fusedNll']:
+                aBotLoss += sum(aBot.forwardDialog(returnNll=True))
+            elif aBot in slBots:
+                for round, ansLogProbs in enumerate(aBot.forwardDialog()):
+                    aBotLoss += utils.maskedNll(
+                        ansLogProbs, gtAnswers[:, round].contiguous())
+            if qBot in slBots and params['fusedNll']:
+                qBotLoss += sum(qBot.forwardDialog(returnNll=True))
+            elif qBot in slBots:
+                for round, quesLogProbs in enumerate(qBot.forwardDialog()):
+                    qBotLoss += utils.maskedNll(
+                        quesLogProbs, gtQuestions[:, round].contiguous())
+
         # Iterating over dialog rounds
         for round in range(numRounds):
             '''
@@ -243,7 +347,7 @@ if __name__ == '__main__':
             forwardFeatNet = (forwardQBot or params['trainMode'] == 'rl-full-QAf')
 
             # Answerer Forward Pass
-            if forwardABot:
+            if forwardABot and round >= dialogRounds:
                 # Observe Ground Truth (GT) question
                 aBot.observe(
                     round,
@@ -254,22 +358,28 @@ if __name__ == '__main__':
                     round,
                     ans=gtAnswers[:, round],
                     ansLens=gtAnsLens[:, round])
-                ansLogProbs = aBot.forward()
                 # Cross Entropy (CE) Loss for Ground Truth Answers
-                aBotLoss += utils.maskedNll(ansLogProbs,
-                                            gtAnswers[:, round].contiguous())
+                if params['fusedNll']:
+                    aBotLoss += aBot.forward(returnNll=True)
+                else:
+                    ansLogProbs = aBot.forward()
+                    aBotLoss += utils.maskedNll(
+                        ansLogProbs, gtAnswers[:, round].contiguous())
 
             # Questioner Forward Pass (dialog model)
-            if forwardQBot:
+            if forwardQBot and round >= dialogRounds:
                 # Observe GT question for teacher forcing
                 qBot.observe(
                     round,
                     ques=gtQuestions[:, round],
                     quesLens=gtQuesLens[:, round])
-                quesLogProbs = qBot.forward()
                 # Cross Entropy (CE) Loss for Ground Truth Questions
-                qBotLoss += utils.maskedNll(quesLogProbs,
-                                            gtQuestions[:, round].contiguous())
+                if params['fusedNll']:
+                    qBotLoss += qBot.forward(returnNll=True)
+                else:
+                    quesLogProbs = qBot.forward()
+                    qBotLoss += utils.maskedNll(
+                        quesLogProbs, gtQuestions[:, round].contiguous())
                 # Observe GT answer for updating dialog history
                 qBot.observe(
                     round,
@@ -283,8 +393,10 @@ if __name__ == '__main__':
 
             # Questioner feature regression network forward pass
             if forwardFeatNet and round < MAX_FEAT_ROUNDS:
-                # Make an image prediction after each round
-                predFeatures = qBot.predictImage()
+                # Make an image prediction after each round (the answer of
+                # this round is only observed yet if Q-Bot was forwarded)
+                predRound = round + 1 if forwardQBot else round
+                predFeatures = qBot.predictImage(predRound)
                 featDist = mse_criterion(predFeatures, image)
                 featDist = torch.mean(featDist)
                 featLoss += featDist
@@ -300,7 +412,7 @@ if __name__ == '__main__':
                 qBot.observe(round, ans=answers, ansLens=ansLens)
 
                 # Q-Bot makes a guess at the end of each round
-                predFeatures = qBot.predictImage()
+                predFeatures = qBot.predictImage(round + 1)
 
                 # Computing reward based on Q-Bot's predicted image
                 featDist = mse_criterion(predFeatures, image)
@@ -365,6 +477,11 @@ if __name__ == '__main__':
             ]
             start_t = end_t
             print(printFormat % tuple(printInfo))
+            if params['prefetchBatches']:
+                print(dataloader.summary())
+                dataloader.reset()
+            if params['verbose'] > 1:
+                print(utils.packingSummary())
 
             # Update line plots
             # if isinstance(aBotLoss, Variable):
@@ -407,8 +524,10 @@ if __name__ == '__main__':
                     aBot,
                     dataset,
                     'val',
-                    scoringFunction=utils.maskedNll,
-                    exampleLimit=25 * params['batchSize'])
+                    scoringFunction=scoringFunction,
+                    exampleLimit=25 * params['batchSize'],
+                    numCandidates=params['rankCandidates'],
+                    optionMemory=params['optionMemory'])
 
                 # for metric, value in rankMetrics.items():
                 #     # viz.linePlot(
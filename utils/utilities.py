@@ -8,6 +8,7 @@ from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence
 
 from six import iteritems
+from timeit import default_timer as timer
 
 
 # Initializing weights
@@ -184,6 +185,68 @@ def getSortedOrder(lens):
     return sortedLen, fwdOrder, bwdOrder
 
 
+# Host-side cost of packed RNN calls, reported by packingSummary
+packingStats = {
+    'calls': 0,
+    'plans': 0,
+    'hostSyncs': 0,
+    'planTime': 0.0,
+    'packTime': 0.0,
+}
+
+
+class PackingPlan(object):
+    def __init__(self, seqLens, device=None):
+        '''
+            Sort order of a batch of sequences with lengths 'seqLens' for
+            packing, computed once on the CPU and reused by every RNN call
+            over sequences with these lengths. Lengths already on the CPU
+            (as produced by collate_fn) need no host-device sync; device
+            lengths (e.g. of sampled sequences) are copied once. 'device'
+            is where the sequences live (default: that of seqLens).
+        '''
+        start = timer()
+        device = seqLens.device if device is None else torch.device(device)
+        lens = seqLens.detach().contiguous().view(-1)
+        if lens.is_cuda:
+            packingStats['hostSyncs'] += 1
+        lens = lens.cpu()
+        self.sortedLen, fwdOrder = torch.sort(lens, dim=0, descending=True)
+        _, bwdOrder = torch.sort(fwdOrder)
+        if device.type == 'cuda':
+            # Pinned, so copies to the device do not block
+            lens = lens.pin_memory()
+            fwdOrder = fwdOrder.pin_memory()
+            bwdOrder = bwdOrder.pin_memory()
+        self.lens = lens
+        self.orders = {torch.device('cpu'): (fwdOrder, bwdOrder)}
+        packingStats['plans'] += 1
+        packingStats['planTime'] += timer() - start
+
+    def getOrders(self, device):
+        '''Forward and backward sort orders on the given device'''
+        if device not in self.orders:
+            self.orders[device] = tuple(
+                order.to(device, non_blocking=True)
+                for order in self.orders[torch.device('cpu')])
+        return self.orders[device]
+
+
+def packingSummary(reset=True):
+    '''Format (and by default reset) the packed RNN counters'''
+    calls = max(packingStats['calls'], 1)
+    summary = '[Packing] %d RNN calls, %d plans (%d host syncs), ' \
+              '%.1fus planning + %.1fus packing per call' % (
+                  packingStats['calls'], packingStats['plans'],
+                  packingStats['hostSyncs'],
+                  1e6 * packingStats['planTime'] / calls,
+                  1e6 * packingStats['packTime'] / calls)
+    if reset:
+        for key in packingStats:
+            packingStats[key] = 0
+    return summary
+
+
 def dynamicRNN(rnnModel,
                seqInput,
                seqLens,
@@ -194,7 +257,8 @@ def dynamicRNN(rnnModel,
         rnnModel     : Any torch.nn RNN model
         seqInput     : (batchSize, maxSequenceLength, embedSize)
                         Input sequence tensor (padded) for RNN model
-        seqLens      : batchSize length torch.LongTensor or numpy array
+        seqLens      : batchSize length torch.LongTensor or a PackingPlan
+                        built from it
         initialState : Initial (hidden, cell) states of RNN
 
     Output:
@@ -204,10 +268,15 @@ def dynamicRNN(rnnModel,
         and cell states at every layer of size (num_layers, batchSize,
         rnnHiddenSize)
     '''
-    sortedLen, fwdOrder, bwdOrder = getSortedOrder(seqLens)
+    if isinstance(seqLens, PackingPlan):
+        plan = seqLens
+    else:
+        plan = PackingPlan(seqLens, seqInput.device)
+    start = timer()
+    fwdOrder, bwdOrder = plan.getOrders(seqInput.device)
     sortedSeqInput = seqInput.index_select(dim=0, index=fwdOrder)
     packedSeqInput = pack_padded_sequence(
-        sortedSeqInput, lengths=sortedLen, batch_first=True)
+        sortedSeqInput, lengths=plan.sortedLen, batch_first=True)
 
     if initialState is not None:
         hx = initialState
@@ -215,13 +284,18 @@ def dynamicRNN(rnnModel,
         assert hx[0].size(0) == rnnModel.num_layers  # Matching num_layers
     else:
         hx = None
+    packTime = timer() - start
     _, (h_n, c_n) = rnnModel(packedSeqInput, hx)
 
+    start = timer()
     rnn_output = h_n[-1].index_select(dim=0, index=bwdOrder)
 
     if returnStates:
         h_n = h_n.index_select(dim=1, index=bwdOrder)
         c_n = c_n.index_select(dim=1, index=bwdOrder)
+    packingStats['calls'] += 1
+    packingStats['packTime'] += packTime + timer() - start
+    if returnStates:
         return rnn_output, (h_n, c_n)
     else:
         return rnn_output
@@ -268,78 +342,155 @@ def maskedNll(seq, gtSeq, returnScores=False):
     return nll_loss
 
 
+class TargetLogProbs(torch.autograd.Function):
+    '''
+    Log probabilities of target tokens under a linear output layer followed
+    by log-softmax, log_softmax(hidden * weight^T + bias)[target]. Rows are
+    processed in chunks of chunkSize so that only a (chunkSize, vocabSize)
+    block of scores exists at a time; the backward pass recomputes scores
+    chunk by chunk instead of keeping them alive.
+    '''
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, target, chunkSize):
+        logNorm = hidden.new_empty(hidden.size(0))
+        targetLogProbs = hidden.new_empty(hidden.size(0))
+        for start in range(0, hidden.size(0), chunkSize):
+            rows = slice(start, start + chunkSize)
+            scores = F.linear(hidden[rows], weight, bias)
+            logNorm[rows] = torch.logsumexp(scores, 1)
+            targetScores = scores.gather(1, target[rows].unsqueeze(1))
+            targetLogProbs[rows] = targetScores.squeeze(1) - logNorm[rows]
+        ctx.save_for_backward(hidden, weight, bias, target, logNorm)
+        ctx.chunkSize = chunkSize
+        return targetLogProbs
+
+    @staticmethod
+    def backward(ctx, gradOutput):
+        hidden, weight, bias, target, logNorm = ctx.saved_tensors
+        needHidden, needWeight, needBias = ctx.needs_input_grad[:3]
+        gradHidden = torch.empty_like(hidden) if needHidden else None
+        gradWeight = torch.zeros_like(weight) if needWeight else None
+        gradBias = torch.zeros_like(bias) if needBias else None
+        for start in range(0, hidden.size(0), ctx.chunkSize):
+            rows = slice(start, start + ctx.chunkSize)
+            scores = F.linear(hidden[rows], weight, bias)
+            # d(log p[target]) / d(scores) = onehot(target) - softmax(scores)
+            gradScores = torch.exp(scores - logNorm[rows].unsqueeze(1)).neg_()
+            gradScores.scatter_add_(
+                1, target[rows].unsqueeze(1),
+                gradScores.new_ones(gradScores.size(0), 1))
+            gradScores.mul_(gradOutput[rows].unsqueeze(1))
+            if needHidden:
+                gradHidden[rows] = gradScores.mm(weight)
+            if needWeight:
+                gradWeight.addmm_(gradScores.t(), hidden[rows])
+            if needBias:
+                gradBias.add_(gradScores.sum(0))
+        return gradHidden, gradWeight, gradBias, None, None
+
+
+def logSumExpScores(hidden, outNet, chunkSize=1024):
+    '''
+    Log normalizer logsumexp(outNet(hidden)) of the output layer 'outNet'
+    (nn.Linear) for each row of hidden, computed in chunks of chunkSize
+    rows so that only a (chunkSize, vocabSize) block of scores exists at
+    a time
+    '''
+    logNorm = [
+        torch.logsumexp(outNet(hidden[start:start + chunkSize]), 1)
+        for start in range(0, hidden.size(0), chunkSize)
+    ]
+    return torch.cat(logNorm)
+
+
+def fusedMaskedNll(outputs, outNet, gtSeq, returnScores=False,
+                   chunkSize=1024):
+    '''
+    Same as maskedNll, but computed from decoder RNN outputs of shape
+    (batchSize, length, rnnHiddenSize) and the output layer 'outNet'
+    (nn.Linear) rather than from a (batchSize, length, vocabSize) tensor
+    of log probabilities, which is never materialized. Padding positions
+    are skipped and target log probabilities are computed with
+    TargetLogProbs in chunks of chunkSize positions.
+    '''
+    # Shifting gtSeq 1 token left to remove <START>
+    target = F.pad(gtSeq, (0, 1))[:, 1:]
+    mask = target.gt(0)
+
+    gtLogProbs = TargetLogProbs.apply(outputs[mask], outNet.weight,
+                                      outNet.bias, target[mask], chunkSize)
+    if returnScores:
+        return outputs.new_zeros(mask.size()).masked_scatter(
+            mask, gtLogProbs).sum(1)
+    return -torch.sum(gtLogProbs) / outputs.size(0)
+
+
+def padAndStack(seqs):
+    '''Right pad (batchSize, length, ...) tensors to a common length and
+    concatenate them along the batch dimension'''
+    maxLen = max(seq.size(1) for seq in seqs)
+    padded = []
+    for seq in seqs:
+        pad = [0, 0] * (seq.dim() - 2) + [0, maxLen - seq.size(1)]
+        padded.append(F.pad(seq, pad))
+    return torch.cat(padded, 0)
+
+
 def concatPaddedSequences(seq1, seqLens1, seq2, seqLens2, padding='right'):
     '''
     Concates two input sequences of shape (batchSize, seqLength). The
     corresponding lengths tensor is of shape (batchSize). Padding sense
     of input sequences needs to be specified as 'right' or 'left'
 
+    Output positions are mapped to positions of the two sequences placed
+    side by side, so the whole batch is gathered at once.
+
     Args:
         seq1, seqLens1 : First sequence tokens and length
         seq2, seqLens2 : Second sequence tokens and length
         padding        : Padding sense of input sequences - either
                          'right' or 'left'
     '''
+    if padding not in ['left', 'right']:
+        raise ValueError("Expected padding to be either 'left' or "
+                         "'right', got '%s' instead." % padding)
 
-    concat_list = []
     cat_seq = torch.cat([seq1, seq2], dim=1)
-    maxLen1 = seq1.size(1)
     maxLen2 = seq2.size(1)
     maxCatLen = cat_seq.size(1)
-    batchSize = seq1.size(0)
-    for b_idx in range(batchSize):
-        # len_1 = seqLens1[b_idx].data[0]
-        # len_2 = seqLens2[b_idx].data[0]
-        len_1 = seqLens1[b_idx].item()
-        len_2 = seqLens2[b_idx].item()
-        cat_len_ = len_1 + len_2
-        if cat_len_ == 0:
-            raise RuntimeError("Both input sequences are empty")
-
-        elif padding == 'left':
-            pad_len_1 = maxLen1 - len_1
-            pad_len_2 = maxLen2 - len_2
-            if len_1 == 0:
-                print("[Warning] Empty input sequence 1 given to "
-                      "concatPaddedSequences")
-                cat_ = seq2[b_idx][pad_len_2:]
-
-            elif len_2 == 0:
-                print("[Warning] Empty input sequence 2 given to "
-                      "concatPaddedSequences")
-                cat_ = seq1[b_idx][pad_len_1:]
-
-            else:
-                cat_ = torch.cat([seq1[b_idx][pad_len_1:],
-                                  seq2[b_idx][pad_len_2:]], 0)
-            cat_padded = F.pad(
-                input=cat_,  # Left pad
-                pad=((maxCatLen - cat_len_), 0),
-                mode="constant",
-                value=0)
-        elif padding == 'right':
-            if len_1 == 0:
-                print("[Warning] Empty input sequence 1 given to "
-                      "concatPaddedSequences")
-                cat_ = seq2[b_idx][:len_1]
-
-            elif len_2 == 0:
-                print("[Warning] Empty input sequence 2 given to "
-                      "concatPaddedSequences")
-                cat_ = seq1[b_idx][:len_1]
-
-            else:
-                cat_ = torch.cat([seq1[b_idx][:len_1],
-                                  seq2[b_idx][:len_2]], 0)
-                # cat_ = cat_seq[b_idx].masked_select(cat_seq[b_idx].ne(0))
-            cat_padded = F.pad(
-                input=cat_,  # Right pad
-                pad=(0, (maxCatLen - cat_len_)),
-                mode="constant",
-                value=0)
-        else:
-            raise (ValueError, "Expected padding to be either 'left' or \
-                                'right', got '%s' instead." % padding)
-        concat_list.append(cat_padded.unsqueeze(0))
-    concat_output = torch.cat(concat_list, 0)
-    return concat_output
+    len_1 = seqLens1.view(-1, 1)
+    len_2 = seqLens2.view(-1, 1)
+    cat_len = len_1 + len_2
+
+    # All checks of the batch at once, a single sync for device lengths
+    numEmpty1, numEmpty2, numEmpty = torch.stack([
+        len_1.eq(0).sum(), len_2.eq(0).sum(), cat_len.eq(0).sum()]).tolist()
+    if numEmpty > 0:
+        raise RuntimeError("Both input sequences are empty")
+    if numEmpty1 > 0:
+        print("[Warning] Empty input sequence 1 given to "
+              "concatPaddedSequences")
+    if numEmpty2 > 0:
+        print("[Warning] Empty input sequence 2 given to "
+              "concatPaddedSequences")
+
+    # Lengths may be given on the CPU, e.g. by a PackingPlan
+    len_1 = len_1.to(cat_seq.device, non_blocking=True)
+    len_2 = len_2.to(cat_seq.device, non_blocking=True)
+    cat_len = len_1 + len_2
+    position = torch.arange(maxCatLen, device=cat_seq.device).unsqueeze(0)
+    if padding == 'right':
+        # Tokens of seq1 are followed by tokens of seq2, then padding
+        inSeq1 = position < len_1
+        source = torch.where(inSeq1, position, position - len_1 + seq1.size(1))
+        isToken = position < cat_len
+    else:
+        # Padding, then tokens of seq1 followed by tokens of seq2, where
+        # the tokens of seq2 are already in place
+        inSeq1 = position < maxCatLen - len_2
+        source = torch.where(inSeq1, position - maxLen2 + len_2, position)
+        isToken = position >= maxCatLen - cat_len
+    source = source.clamp(0, maxCatLen - 1).expand_as(cat_seq)
+    concat_output = cat_seq.gather(1, source)
+    return concat_output.masked_fill(~isToken, 0)
@@ -1,4 +1,7 @@
+import math
+
 import torch
+import torch.distributed as dist
 
 # static list of metrics
 metricList = ['r1', 'r5', 'r10', 'mean', 'mrr']
@@ -7,32 +10,80 @@ metricList = ['r1', 'r5', 'r10', 'mean', 'mrr']
 trends = [1, 1, 1, -1, -1, 1]
 
 
-def evaluateMetric(ranks, metric):
-    ranks = ranks.data.numpy()
-    if metric == 'r1':
-        ranks = ranks.reshape(-1)
-        return 100 * (ranks == 1).sum() / float(ranks.shape[0])
-    if metric == 'r5':
-        ranks = ranks.reshape(-1)
-        return 100 * (ranks <= 5).sum() / float(ranks.shape[0])
-    if metric == 'r10':
-        # ranks = ranks.view(-1)
-        ranks = ranks.reshape(-1)
-        # return 100*torch.sum(ranks <= 10).data[0]/float(ranks.size(0))
-        return 100 * (ranks <= 10).sum() / float(ranks.shape[0])
-    if metric == 'mean':
-        # ranks = ranks.view(-1).float()
-        ranks = ranks.reshape(-1).astype(float)
-        return ranks.mean()
-    if metric == 'mrr':
-        # ranks = ranks.view(-1).float()
-        ranks = ranks.reshape(-1).astype(float)
-        # return torch.reciprocal(ranks).mean().data[0]
-        return (1 / ranks).mean()
+class RankAccumulator(object):
+    def __init__(self, numRounds=1):
+        '''
+            Streaming rank metrics. Each update adds per round counts
+            (number of ranks, hits at 1/5/10, sums of ranks, squared ranks
+            and reciprocal ranks) of a batch of ranks, so the ranks
+            themselves are never stored. Counts stay on the device of the
+            ranks until metrics are computed, and accumulators of different
+            processes can be combined with merge or allReduce.
+
+            Arguments:
+                numRounds : Number of rounds counted separately
+        '''
+        self.numRounds = numRounds
+        # count, r1, r5, r10, sum, sum of squares, sum of reciprocals
+        self.stats = torch.zeros(numRounds, 7, dtype=torch.float64)
+
+    def update(self, ranks, round=0):
+        '''Add a tensor of (1-based) ranks to the counts of round'''
+        ranks = ranks.detach().reshape(-1).to(torch.float64)
+        if self.stats.device != ranks.device:
+            self.stats = self.stats.to(ranks.device)
+        self.stats[round] += torch.stack([
+            ranks.new_tensor(ranks.numel()),
+            ranks.eq(1).sum().to(torch.float64),
+            ranks.le(5).sum().to(torch.float64),
+            ranks.le(10).sum().to(torch.float64),
+            ranks.sum(),
+            (ranks * ranks).sum(),
+            ranks.reciprocal().sum(),
+        ])
+        return self
+
+    def merge(self, other):
+        '''Add the counts of another RankAccumulator'''
+        assert other.numRounds == self.numRounds, "Number of rounds differ"
+        self.stats += other.stats.to(self.stats.device)
+        return self
+
+    def allReduce(self):
+        '''Sum counts over all processes of torch.distributed'''
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.stats)
+        return self
+
+    def counts(self, round=None):
+        '''Counts of round, or summed over all rounds if round is None'''
+        stats = self.stats.cpu()
+        if round is None:
+            return stats.sum(0).tolist()
+        return stats[round].tolist()
+
+    def computeMetrics(self, round=None):
+        '''Metrics in metricList of round, or of all rounds if None'''
+        count, r1, r5, r10, rankSum, _, reciprocalSum = self.counts(round)
+        count = max(count, 1)
+        return {
+            'r1': 100 * r1 / count,
+            'r5': 100 * r5 / count,
+            'r10': 100 * r10 / count,
+            'mean': rankSum / count,
+            'mrr': reciprocalSum / count,
+        }
+
+    def rankStd(self, round=None):
+        '''Standard deviation of ranks of round, or of all rounds if None'''
+        count, _, _, _, rankSum, squareSum, _ = self.counts(round)
+        count = max(count, 1)
+        mean = rankSum / count
+        return math.sqrt(max(squareSum / count - mean * mean, 0))
 
 
 def computeMetrics(ranks):
-    results = {metric: evaluateMetric(ranks, metric) for metric in metricList}
+    results = RankAccumulator().update(ranks.cpu()).computeMetrics()
     # pretty print metrics
     # print('\n')
     # for metric in metricList: print('\t%s : %.3f' % (metric, results[metric]))
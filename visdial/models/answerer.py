@@ -63,10 +63,12 @@ class Answerer(Agent):
             self.answers.append(ans)
         self.encoder.observe(round, ans=ans, caption=caption, **kwargs)
 
-    def forward(self):
+    def forward(self, returnNll=False):
         '''
         Forward pass the last observed answer to compute its log
-        likelihood under the current decoder RNN state.
+        likelihood under the current decoder RNN state. If returnNll is
+        True, the NLL loss of the answer is returned instead of its
+        log-probabilities (see Decoder.forwardNll).
         '''
         encStates = self.encoder()
         if len(self.answers) > 0:
@@ -76,9 +78,36 @@ class Answerer(Agent):
         else:
             raise Exception('Must provide an input sequence')
 
+        if returnNll:
+            return self.decoder.forwardNll(encStates, decIn)
         logProbs = self.decoder(encStates, inputSeq=decIn)
         return logProbs
 
+    def forwardDialog(self, returnNll=False):
+        '''
+        Forward pass all observed answers at once (teacher forcing over the
+        whole dialog). The decoder RNN runs once over batch x rounds, each
+        round starting from the encoder state of that round.
+
+        Output:
+            A list with a (batchSize, length, vocabSize) sized tensor of
+            log-probabilities per round, as forward() returns when called
+            after each round is observed.
+            If returnNll is True, a list of per round NLL losses instead
+        '''
+        numRounds = len(self.answers)
+        encStates = self.encoder.forwardDialog(numRounds)
+        decIn = utils.padAndStack(self.answers)
+        if returnNll:
+            scores = self.decoder.forwardNll(
+                encStates, decIn, returnScores=True)
+            return [-score.sum() / score.size(0)
+                    for score in scores.split(self.encoder.batchSize)]
+        logProbs = self.decoder(encStates, inputSeq=decIn)
+        logProbs = logProbs.split(self.encoder.batchSize)
+        return [logProb[:, :ans.size(1)]
+                for logProb, ans in zip(logProbs, self.answers)]
+
     def forwardDecode(self, inference='sample', beamSize=1, maxSeqLen=20):
         '''
         Decode a sequence (answer) using either sampling or greedy inference.
@@ -101,17 +130,20 @@ class Answerer(Agent):
             beamSize=beamSize)
         return answers, ansLens
 
-    def evalOptions(self, options, optionLens, scoringFunction):
+    def evalOptions(self, options, optionLens, scoringFunction=None,
+                    numCandidates=0, memoryBudget=0):
         '''
         Given the current state (question and conversation history), evaluate
-        a set of candidate answers to the question.
+        a set of candidate answers to the question. See Decoder.evalOptions
+        for scoringFunction, numCandidates and memoryBudget.
 
         Output:
             Log probabilities of candidate options.
         '''
         states = self.encoder()
         return self.decoder.evalOptions(states, options, optionLens,
-                                        scoringFunction)
+                                        scoringFunction, numCandidates,
+                                        memoryBudget)
 
     def reinforce(self, reward):
         # Propogate reinforce function call to decoder
@@ -1,13 +1,15 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
-from torch.distributions import Categorical
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from utils import utilities as utils
 
 
 class Decoder(nn.Module):
+    # Decoding steps between checks for all sequences having ended (GPU)
+    endCheckSteps = 4
+
     def __init__(self,
                  vocabSize,
                  embedSize,
@@ -35,6 +37,10 @@ class Decoder(nn.Module):
             dropout=self.dropout)
         self.outNet = nn.Linear(self.rnnHiddenSize, self.vocabSize)
         self.logSoftmax = nn.LogSoftmax(dim=1)
+        # Log probabilities of tokens sampled by forwardDecode
+        self.saved_log_probs = None
+        # Options kept by the first stage of the last evalOptions call
+        self.optionCandidates = None
 
     def forward(self, encStates, inputSeq):
         '''
@@ -57,9 +63,7 @@ class Decoder(nn.Module):
             the next time step token is indexed out for computing NLL loss.
         '''
         if inputSeq is not None:
-            inputSeq = self.wordEmbed(inputSeq)
-            outputs, _ = self.rnn(inputSeq, encStates)
-            outputs = F.dropout(outputs, self.dropout, training=self.training)
+            outputs = self.rnnOutputs(encStates, inputSeq)
             outputSize = outputs.size()
             # flatOutputs = outputs.view(-1, outputSize[2])
             flatOutputs = outputs.reshape(-1, outputSize[2])
@@ -68,6 +72,66 @@ class Decoder(nn.Module):
             logProbs = flatLogProbs.view(outputSize[0], outputSize[1], -1)
         return logProbs
 
+    def rnnOutputs(self, encStates, inputSeq):
+        '''Teacher forced decoder RNN outputs (with dropout) for inputSeq'''
+        outputs, _ = self.rnn(self.wordEmbed(inputSeq), encStates)
+        return F.dropout(outputs, self.dropout, training=self.training)
+
+    def forwardPacked(self, encStates, inputSeq, seqLens):
+        '''
+        Same as forward(), but the decoder RNN and output layer only run
+        over the first seqLens[i] tokens of each sequence i (packed), so
+        short sequences do not pay for the longest one in the batch.
+
+        Arguments:
+            encStates : (H, C) Tuple of hidden and cell encoder states
+            inputSeq  : Input sequence for computing log probabilities
+            seqLens   : batchSize length torch.LongTensor (preferably on the
+                        CPU) or a PackingPlan built from it; number of time
+                        steps to run per sequence, i.e. number of tokens
+                        including <START> and excluding <END>
+
+        Output:
+            A (batchSize, length, vocabSize) sized tensor of log-probabilities,
+            zero past the length of each sequence
+        '''
+        if isinstance(seqLens, utils.PackingPlan):
+            plan = seqLens
+        else:
+            plan = utils.PackingPlan(seqLens, inputSeq.device)
+        fwdOrder, bwdOrder = plan.getOrders(inputSeq.device)
+        packedSeq = pack_padded_sequence(
+            inputSeq.index_select(0, fwdOrder),
+            lengths=plan.sortedLen,
+            batch_first=True)
+        packedEmbeds = packedSeq._replace(data=self.wordEmbed(packedSeq.data))
+        sortedStates = [x.index_select(1, fwdOrder) for x in encStates]
+        packedOutputs, _ = self.rnn(packedEmbeds, sortedStates)
+
+        outputs = F.dropout(packedOutputs.data, self.dropout,
+                            training=self.training)
+        logProbs = self.logSoftmax(self.outNet(outputs))
+        logProbs, _ = pad_packed_sequence(
+            packedOutputs._replace(data=logProbs),
+            batch_first=True,
+            total_length=inputSeq.size(1))
+        return logProbs.index_select(0, bwdOrder)
+
+    def forwardNll(self, encStates, inputSeq, returnScores=False):
+        '''
+        Given encoder states, compute the NLL of an input sequence under
+        teacher forcing without materializing log-probabilities over the
+        vocabulary (see utils.fusedMaskedNll).
+
+        Output:
+            Same as utils.maskedNll(self.forward(encStates, inputSeq),
+            inputSeq, returnScores), i.e. the NLL loss, or per sequence
+            sums of token log-probabilities if returnScores is True
+        '''
+        outputs = self.rnnOutputs(encStates, inputSeq)
+        return utils.fusedMaskedNll(outputs, self.outNet, inputSeq,
+                                    returnScores=returnScores)
+
     def forwardDecode(self,
                       encStates,
                       maxSeqLen=20,
@@ -95,129 +159,95 @@ class Decoder(nn.Module):
             # Use beam search inference when beam size is > 1
             return self.beamSearchDecoder(encStates, beamSize, maxSeqLen)
 
-        # Determine if cuda tensors are being used
-        if self.wordEmbed.weight.is_cuda:
-            th = torch.cuda
-        else:
-            th = torch
+        if inference not in ['sample', 'greedy']:
+            raise ValueError("Invalid inference type: '{}'".format(inference))
+
+        # Decode on the device of the model
+        device = self.wordEmbed.weight.device
 
-        self.samples = []
         maxLen = maxSeqLen + 1  # Extra <END> token
         batchSize = encStates[0].size(1)
-        # Placeholder for filling in tokens at evert time step
-
-        # seq = th.LongTensor(batchSize, maxLen + 1)
-        # seq = torch.tensor((batchSize, maxLen + 1), dtype=torch.long, device='cuda')
-        # seq = torch.zeros((batchSize, maxLen + 1), dtype=torch.long, device='cuda')
-        seq = torch.zeros((batchSize, maxLen + 1), dtype=torch.long, device='cuda')
-
-        
-
-        seq.fill_(self.endToken)
+        # Buffers filled in at every time step: generated tokens, their log
+        # probabilities (for reinforce) and sampling probabilities
+        seq = torch.full((batchSize, maxLen + 1), self.endToken,
+                         dtype=torch.long, device=device)
         seq[:, 0] = self.startToken
-        seq = Variable(seq, requires_grad=False)
+        dtype = self.outNet.weight.dtype
+        sampleLogProbs = torch.zeros(batchSize, maxLen - 1, dtype=dtype,
+                                     device=device)
+        probs = torch.empty(batchSize, self.vocabSize, dtype=dtype,
+                            device=device)
+
+        # Padding token and <START> are never generated. Additionally,
+        # <END> is not generated at the first step to prevent the
+        # sampling of an empty sequence.
+        forbidden = torch.tensor([0, self.startToken], device=device)
+        forbiddenFirst = torch.tensor([0, self.startToken, self.endToken],
+                                      device=device)
 
         # Initial state linked from encStates
         hid = encStates
 
-        # sampleLens = th.LongTensor(batchSize).fill_(0)
-        sampleLens = torch.zeros(batchSize, dtype=torch.long, device='cuda')
-
-
-        # Tensors needed for tracking sampleLens
-        # unitColumn = th.LongTensor(batchSize).fill_(1)
-        unitColumn = torch.ones(batchSize, dtype=torch.long, device='cuda')
+        # Marks the step at which each sequence generated <END>
+        mask = torch.zeros(seq.size(), dtype=torch.bool, device=device)
+        ended = torch.zeros(batchSize, dtype=torch.bool, device=device)
+        # Reading 'ended' waits for the device, so on GPUs it is only
+        # checked every few steps and the extra steps are trimmed below
+        checkSteps = 1 if device.type == 'cpu' else self.endCheckSteps
 
-
-        # mask = th.ByteTensor(seq.size()).fill_(0)
-        mask = torch.zeros(seq.size(), dtype=torch.bool, device='cuda')
-
-        self.saved_log_probs = []
-
-        # Generating tokens sequentially
+        # Generating tokens sequentially, until every sequence has ended
         for t in range(maxLen - 1):
             emb = self.wordEmbed(seq[:, t:t + 1])
             # emb has shape  (batch, 1, embedSize)
             output, hid = self.rnn(emb, hid)
             # output has shape (batch, 1, rnnHiddenSize)
             scores = self.outNet(output.squeeze(1))
-            logProb = self.logSoftmax(scores)
+            # Mask forbidden tokens in-place, renormalizing over the rest
+            scores.index_fill_(1, forbiddenFirst if t == 0 else forbidden,
+                               float('-inf'))
 
-            # Explicitly removing padding token (index 0) and <START> token
-            # (index -2) from logProbs so that they are never sampled.
-            # This is allows us to keep <START> and padding token in
-            # the decoder vocab without any problems in RL sampling.
-            if t > 0:
-                logProb = torch.cat([logProb[:, 1:-2], logProb[:, -1:]], 1)
-            elif t == 0:
-                # Additionally, remove <END> token from the first sample
-                # to prevent the sampling of an empty sequence.
-                logProb = logProb[:, 1:-2]
-            # This also shifts end token index back by 1
-            END_TOKEN_IDX = self.endToken - 1
-
-            probs = torch.exp(logProb)
             if inference == 'sample':
-                categorical_dist = Categorical(probs)
-                sample = categorical_dist.sample()
+                logProb = self.logSoftmax(scores)
+                torch.exp(logProb.detach(), out=probs)
+                sample = torch.multinomial(probs, 1, True)
                 # Saving log probs for a subsequent reinforce call
-                self.saved_log_probs.append(categorical_dist.log_prob(sample))
-                sample = sample.unsqueeze(-1)
-            elif inference == 'greedy':
-                _, sample = torch.max(probs, dim=1, keepdim=True)
+                sampleLogProbs[:, t] = logProb.gather(1, sample).squeeze(1)
             else:
-                raise ValueError(
-                    "Invalid inference type: '{}'".format(inference))
-
-            # Compensating for removed padding token prediction earlier
-            sample = sample + 1  # Incrementing all token indices by 1
+                _, sample = torch.max(scores.detach(), dim=1, keepdim=True)
 
-            if sample.data.dim() == 1:
-                sample.data = sample.data.unsqueeze(1)
-
-            self.samples.append(sample)
-
-            # seq.data[:, t + 1] = sample.data
             seq.data[:, t + 1] = sample.squeeze(1).data
 
             # Marking spots where <END> token is generated
-            # mask[:, t] = sample.data.eq(END_TOKEN_IDX)
-            mask[:, t] = sample.squeeze(1).eq(END_TOKEN_IDX)
-
-            # Compensating for shift in <END> token index
-            sample.data.masked_fill_(mask[:, t].unsqueeze(1), self.endToken)
-            
-
-        mask[:, maxLen - 1].fill_(1)
-
-        # Computing lengths of generated sequences
-        for t in range(maxLen):
-            # Zero out the spots where end token is reached
-            unitColumn.masked_fill_(mask[:, t], 0)
-            # Update mask
-            mask[:, t] = unitColumn
-            # Add +1 length to all un-ended sequences
-            sampleLens = sampleLens + unitColumn
-
-        # Keep mask for later use in RL reward masking
-        self.mask = Variable(mask, requires_grad=False)
-
-        # Adding <START> to generated answer lengths for consistency
-        sampleLens = sampleLens + 1
-        sampleLens = Variable(sampleLens, requires_grad=False)
-
-        startColumn = sample.data.new(sample.size()).fill_(self.startToken)
-        startColumn = Variable(startColumn, requires_grad=False)
-
-        # Note that we do not add startColumn to self.samples itself
-        # as reinforce is called on self.samples (which needs to be
-        # the output of a stochastic function)
-        gen_samples = [startColumn] + self.samples
+            mask[:, t] = seq[:, t + 1].eq(self.endToken)
 
-        samples = torch.cat(gen_samples, 1)
+            # Stop early once all sequences have generated <END>
+            ended |= mask[:, t]
+            if (t + 1) % checkSteps == 0 and ended.all():
+                break
+        numSteps = t + 1
+        if checkSteps > 1 and ended.all():
+            # Last step at which a sequence generated its first <END>
+            numSteps = mask[:, :numSteps].long().argmax(1).max().item() + 1
+        self.saved_log_probs = \
+            sampleLogProbs[:, :numSteps] if inference == 'sample' else None
+
+        # Sequences which did not end are truncated at the last step
+        mask[:, numSteps].fill_(1)
+        mask = mask[:, :numSteps + 2]
+
+        # Keep mask of steps before <END> for later use in RL reward masking
+        mask = mask.cumsum(1).eq(0)
+        self.mask = mask
+
+        # Computing lengths of generated sequences, adding <START> to
+        # generated answer lengths for consistency
+        sampleLens = mask.sum(1) + 1
+
+        samples = seq[:, :numSteps + 1]
         return samples, sampleLens
 
-    def evalOptions(self, encStates, options, optionLens, scoringFunction):
+    def evalOptions(self, encStates, options, optionLens,
+                    scoringFunction=None, numCandidates=0, memoryBudget=0):
         '''
         Forward pass a set of candidate options to get log probabilities
 
@@ -225,17 +255,60 @@ class Decoder(nn.Module):
             encStates : (H, C) Tuple of hidden and cell encoder states
             options   : (batchSize, numOptions, maxSequenceLength) sized
                         tensor with <START> and <END> tokens
+            optionLens: (batchSize, numOptions) sized tensor of option
+                        lengths (tokens including <START>, excluding
+                        <END>); with a scoringFunction, options are
+                        packed to these lengths
 
             scoringFunction : A function which computes negative log
                               likelihood of a sequence (answer) given log
                               probabilities under an RNN model. Currently
                               utils.maskedNll is the only such function used.
+                              If None, options are scored with
+                              evalOptionsTrie without materializing log
+                              probabilities of every option.
+            numCandidates   : If non-zero, only the top numCandidates
+                              options under bagOfWordsScores are scored by
+                              the decoder. The other options are ranked
+                              below them, in first stage order. Indices of
+                              the candidates are kept in
+                              self.optionCandidates.
+            memoryBudget    : If non-zero, options are scored sequentially
+                              in chunks whose scoring needs about
+                              memoryBudget MB (see evalOptionsChunked)
 
         Output:
             A (batchSize, numOptions) tensor containing the score
             of each option sentence given by the generator
         '''
         batchSize, numOptions, maxLen = options.size()
+        assert options.device == encStates[0].device, \
+            "Options and encoder states must be on the same device"
+        self.optionCandidates = None
+        if 0 < numCandidates < numOptions:
+            firstScores = self.bagOfWordsScores(encStates, options)
+            _, candidates = firstScores.topk(numCandidates, dim=1)
+            candidateOptions = options.gather(
+                1, candidates.unsqueeze(2).expand(-1, -1, maxLen))
+            # Option lengths may stay on the CPU for packing
+            candidateLens = optionLens.gather(
+                1, candidates.to(optionLens.device))
+            candidateScores = self.evalOptions(
+                encStates, candidateOptions, candidateLens,
+                scoringFunction, memoryBudget=memoryBudget)
+            self.optionCandidates = candidates
+            # Shift first stage scores below all candidate scores
+            scores = firstScores - firstScores.max(1, keepdim=True)[0] + \
+                candidateScores.min(1, keepdim=True)[0] - 1
+            return scores.scatter(1, candidates, candidateScores)
+
+        if memoryBudget:
+            return self.evalOptionsChunked(encStates, options, optionLens,
+                                           scoringFunction, memoryBudget)
+
+        if scoringFunction is None:
+            return self.evalOptionsTrie(encStates, options)
+
         optionsFlat = options.contiguous().view(-1, maxLen)
 
         # Reshaping H, C for each option
@@ -243,10 +316,132 @@ class Decoder(nn.Module):
                         view(self.numLayers, -1, self.rnnHiddenSize)
                         for x in encStates]
 
-        logProbs = self.forward(encStates, inputSeq=optionsFlat)
+        logProbs = self.forwardPacked(encStates, optionsFlat,
+                                      optionLens.reshape(-1))
         scores = scoringFunction(logProbs, optionsFlat, returnScores=True)
         return scores.view(batchSize, numOptions)
 
+    def evalOptionsChunked(self, encStates, options, optionLens,
+                           scoringFunction, memoryBudget):
+        '''
+        Score options like evalOptions, sequentially in chunks sized so
+        that the log probabilities and decoder activations of a chunk take
+        about memoryBudget MB. Scores are written into a preallocated
+        (batchSize, numOptions) matrix, so peak memory does not grow with
+        batchSize x numOptions. Trie scoring shares prefixes between the
+        options of a batch element, so it is chunked by batch elements;
+        otherwise chunks are flat ranges of options, each trimmed to its
+        longest option.
+        '''
+        batchSize, numOptions, maxLen = options.size()
+        weight = self.outNet.weight
+        # Per token: scores, log probabilities and their padded copy over
+        # the vocabulary, plus embedding and LSTM activations
+        optionBytes = maxLen * weight.element_size() * (
+            3 * self.vocabSize + self.embedSize +
+            4 * self.numLayers * self.rnnHiddenSize)
+        chunkSize = max(1, int(memoryBudget * 2**20 // optionBytes))
+        scores = torch.empty(batchSize, numOptions, dtype=weight.dtype,
+                             device=weight.device)
+
+        if scoringFunction is None:
+            rowsPerChunk = max(1, chunkSize // numOptions)
+            for start in range(0, batchSize, rowsPerChunk):
+                end = min(start + rowsPerChunk, batchSize)
+                states = [x[:, start:end] for x in encStates]
+                scores[start:end] = self.evalOptionsTrie(
+                    states, options[start:end])
+            return scores
+
+        optionsFlat = options.reshape(-1, maxLen)
+        optionLensFlat = optionLens.reshape(-1)
+        batchInds = torch.arange(
+            batchSize, device=encStates[0].device).repeat_interleave(
+                numOptions)
+        scoresFlat = scores.view(-1)
+        for start in range(0, batchSize * numOptions, chunkSize):
+            end = min(start + chunkSize, batchSize * numOptions)
+            chunkLens = optionLensFlat[start:end]
+            chunkLen = min(int(chunkLens.max()) + 1, maxLen)
+            states = [x.index_select(1, batchInds[start:end])
+                      for x in encStates]
+            scoresFlat[start:end] = self.evalOptions(
+                states, optionsFlat[start:end, :chunkLen].unsqueeze(1),
+                chunkLens.unsqueeze(1), scoringFunction).view(-1)
+        return scores
+
+    def bagOfWordsScores(self, encStates, options):
+        '''
+        Cheap first stage option scores for evalOptions: the sum of log
+        probabilities of each option's tokens under the decoder's first
+        step distribution (after <START>). This is a dot product between
+        the log-softmax of that single step and a bag of words vector of
+        each option, so the decoder runs one step per batch element
+        instead of one step per option token.
+
+        Output:
+            A (batchSize, numOptions) tensor of first stage scores
+        '''
+        batchSize, numOptions, maxLen = options.size()
+        startTokens = options.new_full((batchSize, 1), self.startToken)
+        logProbs = self.forward(encStates, inputSeq=startTokens).squeeze(1)
+        targets = options[:, :, 1:].reshape(batchSize, -1)
+        tokenLogProbs = logProbs.gather(1, targets) * targets.gt(0).float()
+        return tokenLogProbs.view(batchSize, numOptions, -1).sum(2)
+
+    def evalOptionsTrie(self, encStates, options):
+        '''
+        Score a set of candidate options like evalOptions with
+        utils.maskedNll, sharing computation between options with common
+        prefixes. The options of each batch element form a token trie
+        (built level by level), the decoder RNN and output layer run once
+        per unique trie node and each option sums the log probabilities
+        of its tokens along its path.
+
+        Arguments:
+            encStates : (H, C) Tuple of hidden and cell encoder states
+            options   : (batchSize, numOptions, maxSequenceLength) sized
+                        tensor with <START> and <END> tokens
+
+        Output:
+            A (batchSize, numOptions) tensor containing the sum of token
+            log probabilities of each option
+        '''
+        batchSize, numOptions, maxLen = options.size()
+        optionsFlat = options.contiguous().view(-1, maxLen)
+        scores = self.outNet.weight.new_zeros(batchSize * numOptions)
+
+        # Options still having a token to predict, and the trie node (the
+        # batch element at the root) each of them is at
+        active = torch.arange(batchSize * numOptions, device=options.device)
+        nodes = active // numOptions
+        states = encStates
+        for t in range(maxLen - 1):
+            # Teacher forced target is the next token, padding is skipped
+            keep = optionsFlat[active, t + 1].gt(0)
+            active, nodes = active[keep], nodes[keep]
+            if len(active) == 0:
+                break
+            target = optionsFlat[active, t + 1]
+
+            # Child nodes are unique (parent node, input token) pairs
+            keys = nodes * self.vocabSize + optionsFlat[active, t]
+            keys, nodes = torch.unique(keys, return_inverse=True)
+            parents, tokens = keys // self.vocabSize, keys % self.vocabSize
+
+            states = [x.index_select(1, parents) for x in states]
+            emb = self.wordEmbed(tokens.unsqueeze(1))
+            outputs, states = self.rnn(emb, states)
+            outputs = F.dropout(outputs.squeeze(1), self.dropout,
+                                training=self.training)
+
+            # log softmax of the target tokens, normalized once per node
+            logNorm = utils.logSumExpScores(outputs, self.outNet)
+            targetScores = (outputs[nodes] * self.outNet.weight[target]).sum(1)
+            targetScores = targetScores + self.outNet.bias[target]
+            scores[active] += targetScores - logNorm[nodes]
+        return scores.view(batchSize, numOptions)
+
     def reinforce(self, reward):
         '''
         Compute loss using REINFORCE on log probabilities of tokens
@@ -254,217 +449,142 @@ class Decoder(nn.Module):
 
         Note that an earlier call to forwardDecode must have been
         made in order to have samples for which REINFORCE can be
-        applied. These samples are stored in 'self.saved_log_probs'.
+        applied. Log probabilities of these samples are stored in
+        'self.saved_log_probs' as a (batchSize, numSteps) tensor.
         '''
-        loss = 0
-        # samples = torch.stack(self.samples, 1)
-        # sampleLens = self.sampleLens - 1
-        if len(self.saved_log_probs) == 0:
+        if self.saved_log_probs is None:
             raise RuntimeError("Reinforce called without sampling in Decoder")
 
-        for t, log_prob in enumerate(self.saved_log_probs):
-            loss += -1 * log_prob * (reward * (self.mask[:, t].float()))
+        numSteps = self.saved_log_probs.size(1)
+        mask = self.mask[:, :numSteps].float()
+        loss = -1 * (self.saved_log_probs * mask).sum(1) * reward
         return loss
 
-    def beamSearchDecoder(self, initStates, beamSize, maxSeqLen):
+    def beamSearchDecoder(self, initStates, beamSize, maxSeqLen, nBest=1):
         '''
-        Beam search for sequence generation
+        Beam search for sequence generation, over all batch elements at once
 
         Arguments:
             initStates - Initial encoder states tuple
             beamSize - Beam Size
             maxSeqLen - Maximum length of sequence to decode
+            nBest - Number of top beams to return for each batch element
+
+        Output:
+            Tokens (batchSize, length) and lengths (batchSize) of the top
+            beam, or of shape (batchSize, nBest, length) and (batchSize,
+            nBest) for the nBest top beams (best first) if nBest > 1
         '''
 
         # For now, use beam search for evaluation only
         assert self.training == False
+        assert nBest <= beamSize, "Can not return more beams than searched"
 
-        # Determine if cuda tensors are being used
-        if self.wordEmbed.weight.is_cuda:
-            th = torch.cuda
-        else:
-            th = torch
+        # Decode on the device of the model
+        device = self.wordEmbed.weight.device
 
         LENGTH_NORM = True
         maxLen = maxSeqLen + 1  # Extra <END> token
-        # batchSize = initStates[0].size(1)
-        batchSize = 1
-
-        startTokenArray = th.LongTensor(batchSize, 1).fill_(self.startToken)
-        backVector = th.LongTensor(beamSize)
-        torch.arange(0, beamSize, out=backVector)
-        backVector = backVector.unsqueeze(0).repeat(batchSize, 1)
-
-        tokenArange = th.LongTensor(self.vocabSize)
-        torch.arange(0, self.vocabSize, out=tokenArange)
-        tokenArange = Variable(tokenArange)
-
-        startTokenArray = Variable(startTokenArray)
-        backVector = Variable(backVector)
-        hiddenStates = initStates
+        batchSize = initStates[0].size(1)
 
         # Inits
-        beamTokensTable = th.LongTensor(batchSize, beamSize, maxLen).fill_(
-            self.endToken)
-        beamTokensTable = Variable(beamTokensTable)
-        backIndices = th.LongTensor(batchSize, beamSize, maxLen).fill_(-1)
-        backIndices = Variable(backIndices)
-
-        aliveVector = beamTokensTable[:, :, 0].eq(self.endToken).unsqueeze(2)
-
-        for t in range(maxLen - 1):  # Beam expansion till maxLen]
-            if t == 0:
-                # First column of beamTokensTable is generated from <START> token
-                emb = self.wordEmbed(startTokenArray)
-                # emb has shape (batchSize, 1, embedSize)
-                output, hiddenStates = self.rnn(emb, hiddenStates)
-                # output has shape (batchSize, 1, rnnHiddenSize)
-                scores = self.outNet(output.squeeze(1))
-                logProbs = self.logSoftmax(scores)
-                # scores & logProbs has shape (batchSize, vocabSize)
-
-                # Find top beamSize logProbs
-                topLogProbs, topIdx = logProbs.topk(beamSize, dim=1)
-
-                # beamTokensTable[:, :, 0] = topIdx.transpose(0, 1).data
-
-                # Ensure contiguous for assignment
-                transposed_topIdx = topIdx.transpose(0, 1).contiguous()
-
-                # Adjust assignment based on expected dimensions
-                # beamTokensTable[:, :, 0] = transposed_topIdx.view(1, -1)
-
-                # Ensure transposed_topIdx has the correct dimensions
-                transposed_topIdx = transposed_topIdx.view(batchSize, beamSize)
-                # Assign the reshaped tensor to beamTokensTable
-                beamTokensTable[:, :, 0] = transposed_topIdx
-
-
-                logProbSums = topLogProbs
-
-                # Repeating hiddenStates 'beamSize' times for subsequent self.rnn calls
-                hiddenStates = [
-                    x.unsqueeze(2).repeat(1, 1, beamSize, 1)
-                    for x in hiddenStates
-                ]
-                hiddenStates = [
-                    x.view(self.numLayers, -1, self.rnnHiddenSize)
-                    for x in hiddenStates
-                ]
-                # H_0 and C_0 have shape (numLayers, batchSize*beamSize, rnnHiddenSize)
+        beamTokensTable = torch.full((batchSize, beamSize, maxLen),
+                                     self.endToken, dtype=torch.long,
+                                     device=device)
+        backIndices = torch.full((batchSize, beamSize, maxLen), -1,
+                                 dtype=torch.long, device=device)
+        # Offsets of each batch element in the flattened batch x beam states
+        beamOffsets = torch.arange(batchSize, device=device).unsqueeze(1) * \
+            beamSize
+
+        # First column of beamTokensTable is generated from <START> token
+        startTokenArray = torch.full((batchSize, 1), self.startToken,
+                                     dtype=torch.long, device=device)
+        emb = self.wordEmbed(startTokenArray)
+        # emb has shape (batchSize, 1, embedSize)
+        output, hiddenStates = self.rnn(emb, initStates)
+        # output has shape (batchSize, 1, rnnHiddenSize)
+        logProbs = self.logSoftmax(self.outNet(output.squeeze(1)))
+        # Find top beamSize logProbs
+        logProbSums, beamTokensTable[:, :, 0] = logProbs.topk(beamSize, dim=1)
+
+        # Repeating hiddenStates 'beamSize' times for subsequent self.rnn calls
+        hiddenStates = [
+            x.unsqueeze(2).repeat(1, 1, beamSize, 1).view(
+                self.numLayers, -1, self.rnnHiddenSize) for x in hiddenStates
+        ]
+        # H_0 and C_0 have shape (numLayers, batchSize*beamSize, rnnHiddenSize)
+
+        # Detecting endToken to end beams, tracked per batch element and beam
+        aliveVector = beamTokensTable[:, :, 0:1].ne(self.endToken)
+        finalLen = 0
+        for t in range(1, maxLen - 1):  # Beam expansion till maxLen
+            if not aliveVector.any():
+                break
+            # Subsequent columns are generated from previous tokens
+            emb = self.wordEmbed(beamTokensTable[:, :, t - 1])
+            # emb has shape (batchSize, beamSize, embedSize)
+            output, hiddenStates = self.rnn(
+                emb.view(-1, 1, self.embedSize), hiddenStates)
+            # output has shape (batchSize*beamSize, 1, rnnHiddenSize)
+            scores = self.outNet(output.squeeze(1))
+            logProbsCurrent = self.logSoftmax(scores)
+            # logProbs has shape (batchSize*beamSize, vocabSize)
+            # NOTE: Padding token has been removed from generator output during
+            # sampling (RL fine-tuning). However, the padding token is still
+            # present in the generator vocab and needs to be handled in this
+            # beam search function. This will be supported in a future release.
+            logProbsCurrent = logProbsCurrent.view(batchSize, beamSize,
+                                                   self.vocabSize)
+
+            alive = aliveVector.float()
+            if LENGTH_NORM:
+                # Add (current log probs / (t+1))
+                logProbs = logProbsCurrent * (alive / (t + 1))
+                # Add (previous log probs * (t/t+1) ) <- Mean update
+                coeff_ = (1 - alive) + alive * t / (t + 1)
+                logProbs += logProbSums.unsqueeze(2) * coeff_
             else:
-                # Subsequent columns are generated from previous tokens
-                emb = self.wordEmbed(beamTokensTable[:, :, t - 1])
-                # emb has shape (batchSize, beamSize, embedSize)
-                output, hiddenStates = self.rnn(
-                    emb.view(-1, 1, self.embedSize), hiddenStates)
-                # output has shape (batchSize*beamSize, 1, rnnHiddenSize)
-                scores = self.outNet(output.squeeze())
-                logProbsCurrent = self.logSoftmax(scores)
-                # logProbs has shape (batchSize*beamSize, vocabSize)
-                # NOTE: Padding token has been removed from generator output during
-                # sampling (RL fine-tuning). However, the padding token is still
-                # present in the generator vocab and needs to be handled in this
-                # beam search function. This will be supported in a future release.
-                logProbsCurrent = logProbsCurrent.view(batchSize, beamSize,
-                                                       self.vocabSize)
-
-                if LENGTH_NORM:
-                    # Add (current log probs / (t+1))
-                    logProbs = logProbsCurrent * (aliveVector.float() /
-                                                  (t + 1))
-                    # Add (previous log probs * (t/t+1) ) <- Mean update
-                    coeff_ = aliveVector.eq(0).float() + (
-                        aliveVector.float() * t / (t + 1))
-                    logProbs += logProbSums.unsqueeze(2) * coeff_
-                else:
-                    # Add currrent token logProbs for alive beams only
-                    logProbs = logProbsCurrent * (aliveVector.float())
-                    # Add previous logProbSums upto t-1
-                    logProbs += logProbSums.unsqueeze(2)
-
-                # Masking out along |V| dimension those sequence logProbs
-                # which correspond to ended beams so as to only compare
-                # one copy when sorting logProbs
-                mask_ = aliveVector.eq(0).repeat(1, 1, self.vocabSize)
-                mask_[:, :,
-                      0] = 0  # Zeroing all except first row for ended beams
-                
-                minus_infinity_ = torch.min(logProbs).item()
-                # minus_infinity_ = torch.min(logProbs).data[0]
-
-
-                logProbs.data.masked_fill_(mask_.data, minus_infinity_)
-
-                logProbs = logProbs.view(batchSize, -1)
-                tokensArray = tokenArange.unsqueeze(0).unsqueeze(0).\
-                                repeat(batchSize,beamSize,1)
-                tokensArray.masked_fill_(aliveVector.eq(0), self.endToken)
-                tokensArray = tokensArray.view(batchSize, -1)
-                backIndexArray = backVector.unsqueeze(2).\
-                                repeat(1,1,self.vocabSize).view(batchSize,-1)
-
-                topLogProbs, topIdx = logProbs.topk(beamSize, dim=1)
-
-                logProbSums = topLogProbs
-                beamTokensTable[:, :, t] = tokensArray.gather(1, topIdx)
-                backIndices[:, :, t] = backIndexArray.gather(1, topIdx)
-
-                # Update corresponding hidden and cell states for next time step
-                hiddenCurrent, cellCurrent = hiddenStates
-
-                # Reshape to get explicit beamSize dim
-                original_state_size = hiddenCurrent.size()
-                num_layers, _, rnnHiddenSize = original_state_size
-                hiddenCurrent = hiddenCurrent.view(
-                    num_layers, batchSize, beamSize, rnnHiddenSize)
-                cellCurrent = cellCurrent.view(
-                    num_layers, batchSize, beamSize, rnnHiddenSize)
-
-                # Update states according to the next top beams
-                backIndexVector = backIndices[:, :, t].unsqueeze(0)\
-                    .unsqueeze(-1).repeat(num_layers, 1, 1, rnnHiddenSize)
-                hiddenCurrent = hiddenCurrent.gather(2, backIndexVector)
-                cellCurrent = cellCurrent.gather(2, backIndexVector)
-
-                # Restore original shape for next rnn forward
-                hiddenCurrent = hiddenCurrent.view(*original_state_size)
-                cellCurrent = cellCurrent.view(*original_state_size)
-                hiddenStates = (hiddenCurrent, cellCurrent)
-
-            # Detecting endToken to end beams
-            aliveVector = beamTokensTable[:, :, t:t + 1].ne(self.endToken)
-            aliveBeams = aliveVector.data.long().sum()
+                # Add currrent token logProbs for alive beams only
+                logProbs = logProbsCurrent * alive
+                # Add previous logProbSums upto t-1
+                logProbs += logProbSums.unsqueeze(2)
+
+            # Masking out along |V| dimension those sequence logProbs
+            # which correspond to ended beams so as to only compare
+            # one copy when sorting logProbs
+            logProbs[:, :, 1:].masked_fill_(~aliveVector, float('-inf'))
+
+            logProbSums, topIdx = logProbs.view(batchSize, -1).topk(
+                beamSize, dim=1)
+            backIndex = topIdx // self.vocabSize
+            tokens = topIdx % self.vocabSize
+            # Ended beams are only extended by <END>
+            parentAlive = aliveVector.squeeze(2).gather(1, backIndex)
+            tokens.masked_fill_(~parentAlive, self.endToken)
+            beamTokensTable[:, :, t] = tokens
+            backIndices[:, :, t] = backIndex
+
+            # Update corresponding hidden and cell states for next time step
+            stateIndex = (backIndex + beamOffsets).view(-1)
+            hiddenStates = [x.index_select(1, stateIndex) for x in hiddenStates]
+
+            aliveVector = tokens.ne(self.endToken).unsqueeze(2)
             finalLen = t
-            if aliveBeams == 0:
-                break
 
-        # Backtracking to get final beams
-        beamTokensTable = beamTokensTable.data
-        backIndices = backIndices.data
-
-        # Keep this on when returning the top beam
-        RECOVER_TOP_BEAM_ONLY = True
-
-        tokenIdx = finalLen
-        backID = backIndices[:, :, tokenIdx]
-        tokens = []
-        while (tokenIdx >= 0):
-            tokens.append(beamTokensTable[:,:,tokenIdx].\
-                        gather(1, backID).unsqueeze(2))
-            backID = backIndices[:, :, tokenIdx].\
-                        gather(1, backID)
-            tokenIdx = tokenIdx - 1
-
-        tokens.append(startTokenArray.unsqueeze(2).repeat(1, beamSize, 1).data)
-        tokens.reverse()
-        tokens = torch.cat(tokens, 2)
+        # Backtracking to get final beams, for all batch elements and beams
+        tokens = beamTokensTable.new_full(
+            (batchSize, beamSize, finalLen + 2), self.endToken)
+        tokens[:, :, 0] = self.startToken
+        beamIndex = torch.arange(beamSize, device=device).repeat(batchSize, 1)
+        for t in range(finalLen, -1, -1):
+            tokens[:, :, t + 1] = beamTokensTable[:, :, t].gather(1, beamIndex)
+            if t > 0:
+                beamIndex = backIndices[:, :, t].gather(1, beamIndex)
         seqLens = tokens.ne(self.endToken).long().sum(dim=2)
 
-        if RECOVER_TOP_BEAM_ONLY:
-            # 'tokens' has shape (batchSize, beamSize, maxLen)
-            # 'seqLens' has shape (batchSize, beamSize)
-            tokens = tokens[:, 0]  # Keep only top beam
-            seqLens = seqLens[:, 0]
-
-        return Variable(tokens), Variable(seqLens)
+        # 'tokens' has shape (batchSize, beamSize, maxLen), with beams sorted
+        # by score; 'seqLens' has shape (batchSize, beamSize)
+        if nBest == 1:
+            return tokens[:, 0], seqLens[:, 0]
+        return tokens[:, :nBest], seqLens[:, :nBest]
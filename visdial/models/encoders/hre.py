@@ -90,14 +90,17 @@ class Encoder(nn.Module):
         self.captionTokens = None
         self.captionEmbed = None
         self.captionLens = None
+        self.captionPlan = None
 
         self.questionTokens = []
         self.questionEmbeds = []
         self.questionLens = []
+        self.questionPlans = []
 
         self.answerTokens = []
         self.answerEmbeds = []
         self.answerLengths = []
+        self.answerPlans = []
 
         # Hidden embeddings
         self.factEmbeds = []
@@ -129,6 +132,9 @@ class Encoder(nn.Module):
         Note that all input sequences are assumed to be left-aligned (i.e.
         right-padded). Internally this alignment is changed to right-align
         for ease in computing final time step hidden states of each RNN
+
+        Packing plans of observed sequences are built here, once. Lengths
+        given on the CPU avoid any host-device sync in the RNNs.
         '''
         if image is not None:
             assert round == -1
@@ -141,19 +147,22 @@ class Encoder(nn.Module):
             caption, captionLens = self.processSequence(caption, captionLens)
             self.captionTokens = caption
             self.captionLens = captionLens
+            self.captionPlan = utils.PackingPlan(captionLens, caption.device)
             self.batchSize = len(self.captionTokens)
         if ques is not None:
-            assert round == len(self.questionEmbeds)
+            assert round == len(self.questionTokens)
             assert quesLens is not None, "Questions lengths required!"
             ques, quesLens = self.processSequence(ques, quesLens)
             self.questionTokens.append(ques)
             self.questionLens.append(quesLens)
+            self.questionPlans.append(utils.PackingPlan(quesLens, ques.device))
         if ans is not None:
-            assert round == len(self.answerEmbeds)
+            assert round == len(self.answerTokens)
             assert ansLens is not None, "Answer lengths required!"
             ans, ansLens = self.processSequence(ans, ansLens)
             self.answerTokens.append(ans)
             self.answerLengths.append(ansLens)
+            self.answerPlans.append(utils.PackingPlan(ansLens, ans.device))
 
     def processSequence(self, seq, seqLen):
         ''' Strip <START> and <END> token from a left-aligned sequence'''
@@ -187,22 +196,24 @@ class Encoder(nn.Module):
         '''Embed facts i.e. caption and round 0 or question-answer pair otherwise'''
         # Caption
         if factIdx == 0:
-            seq, seqLens = self.captionEmbed, self.captionLens
+            seq, seqPlan = self.captionEmbed, self.captionPlan
             factEmbed, states = utils.dynamicRNN(
-                self.factRNN, seq, seqLens, returnStates=True)
+                self.factRNN, seq, seqPlan, returnStates=True)
         # QA pairs
         elif factIdx > 0:
             quesTokens, quesLens = \
-                self.questionTokens[factIdx - 1], self.questionLens[factIdx - 1]
+                self.questionTokens[factIdx - 1], \
+                self.questionPlans[factIdx - 1].lens
             ansTokens, ansLens = \
-                self.answerTokens[factIdx - 1], self.answerLengths[factIdx - 1]
+                self.answerTokens[factIdx - 1], \
+                self.answerPlans[factIdx - 1].lens
 
             qaTokens = utils.concatPaddedSequences(
                 quesTokens, quesLens, ansTokens, ansLens, padding='right')
             qa = self.wordEmbed(qaTokens)
-            qaLens = quesLens + ansLens
+            qaPlan = utils.PackingPlan(quesLens + ansLens, qa.device)
             qaEmbed, states = utils.dynamicRNN(
-                self.factRNN, qa, qaLens, returnStates=True)
+                self.factRNN, qa, qaPlan, returnStates=True)
             factEmbed = qaEmbed
         factRNNstates = states
         self.factEmbeds.append((factEmbed, factRNNstates))
@@ -210,15 +221,94 @@ class Encoder(nn.Module):
     def embedQuestion(self, qIdx):
         '''Embed questions'''
         quesIn = self.questionEmbeds[qIdx]
-        quesLens = self.questionLens[qIdx]
+        quesPlan = self.questionPlans[qIdx]
         if self.useIm == 'early':
             image = self.imageEmbed.unsqueeze(1).repeat(1, quesIn.size(1), 1)
             quesIn = torch.cat([quesIn, image], 2)
         qEmbed, states = utils.dynamicRNN(
-            self.quesRNN, quesIn, quesLens, returnStates=True)
+            self.quesRNN, quesIn, quesPlan, returnStates=True)
         quesRNNstates = states
         self.questionRNNStates.append((qEmbed, quesRNNstates))
 
+    def embedFactsBulk(self, numFacts=None):
+        '''
+        Embed all facts not embedded yet (caption and every observed
+        question-answer pair, or only the first numFacts facts) with a
+        single packed factRNN call over batch x facts, instead of one call
+        per round in embedFact
+        '''
+        numObserved = min(len(self.questionTokens), len(self.answerTokens)) + 1
+        if numFacts is None or numFacts > numObserved:
+            numFacts = numObserved
+        start = len(self.factEmbeds)
+        if start >= numFacts:
+            return
+        tokens, lens = [], []
+        if start == 0:
+            tokens.append(self.captionTokens)
+            lens.append(self.captionPlan.lens)
+            start = 1
+        # QA pairs of all rounds, concatenated at once
+        rounds = range(start - 1, numFacts - 1)
+        if len(rounds) > 0:
+            quesLens = [self.questionPlans[r].lens for r in rounds]
+            ansLens = [self.answerPlans[r].lens for r in rounds]
+            qaTokens = utils.concatPaddedSequences(
+                utils.padAndStack([self.questionTokens[r] for r in rounds]),
+                torch.cat(quesLens),
+                utils.padAndStack([self.answerTokens[r] for r in rounds]),
+                torch.cat(ansLens),
+                padding='right')
+            tokens.append(qaTokens)
+            lens.extend([q + a for q, a in zip(quesLens, ansLens)])
+
+        facts = self.wordEmbed(utils.padAndStack(tokens))
+        factPlan = utils.PackingPlan(torch.cat(lens), facts.device)
+        factEmbed, (h_n, c_n) = utils.dynamicRNN(
+            self.factRNN, facts, factPlan, returnStates=True)
+        for idx, embed in enumerate(factEmbed.split(self.batchSize)):
+            rows = slice(idx * self.batchSize, (idx + 1) * self.batchSize)
+            self.factEmbeds.append((embed, (h_n[:, rows], c_n[:, rows])))
+
+    def embedQuestionsBulk(self, numQuestions=None):
+        '''
+        Embed all observed questions not embedded yet (or only the first
+        numQuestions questions) with a single packed quesRNN call over
+        batch x rounds, instead of one call per round in embedQuestion
+        (A-Bot only)
+        '''
+        self.embedInputDialog()
+        if numQuestions is None or numQuestions > len(self.questionTokens):
+            numQuestions = len(self.questionTokens)
+        rounds = range(len(self.questionRNNStates), numQuestions)
+        if len(rounds) == 0:
+            return
+        quesIn = utils.padAndStack([self.questionEmbeds[r] for r in rounds])
+        if self.useIm == 'early':
+            image = self.imageEmbed.repeat(len(rounds), 1)
+            image = image.unsqueeze(1).expand(-1, quesIn.size(1), -1)
+            quesIn = torch.cat([quesIn, image], 2)
+        quesPlan = utils.PackingPlan(
+            torch.cat([self.questionPlans[r].lens for r in rounds]),
+            quesIn.device)
+        qEmbed, (h_n, c_n) = utils.dynamicRNN(
+            self.quesRNN, quesIn, quesPlan, returnStates=True)
+        for idx, embed in enumerate(qEmbed.split(self.batchSize)):
+            rows = slice(idx * self.batchSize, (idx + 1) * self.batchSize)
+            self.questionRNNStates.append(
+                (embed, (h_n[:, rows], c_n[:, rows])))
+
+    def embedBulk(self, round=None):
+        '''
+        Encode every observed round (or rounds up to and including 'round')
+        at once, e.g. for teacher forced training where the whole dialog is
+        known up front. Subsequent calls to forward only step the dialogRNN.
+        '''
+        numRounds = None if round is None else round + 1
+        self.embedFactsBulk(numRounds)
+        if self.isAnswerer:
+            self.embedQuestionsBulk(numRounds)
+
     def concatDialogRNNInput(self, histIdx):
         currIns = [self.factEmbeds[histIdx][0]]
         if self.isAnswerer:
@@ -237,8 +327,12 @@ class Encoder(nn.Module):
         hNew = self.dialogRNN(inpt, hPrev)
         self.dialogHiddens.append(hNew)
 
-    def forward(self):
+    def forward(self, round=None):
         '''
+        Arguments:
+            round : Dialog round to compute states for, defaults to the
+                    current (last observed) round
+
         Returns:
             A tuple of tensors (H, C) each of shape (batchSize, rnnHiddenSize)
             to be used as the initial Hidden and Cell states of the Decoder.
@@ -248,12 +342,12 @@ class Encoder(nn.Module):
         # Lazily embed input Image, Captions, Questions and Answers
         self.embedInputDialog()
 
-        if self.isAnswerer:
+        if round is None and self.isAnswerer:
             # For A-Bot, current round is the number of facts present,
             # which is number of questions observed - 1 (as opposed
             # to len(self.answerEmbeds), which may be inaccurate as
             round = len(self.questionEmbeds) - 1
-        else:
+        elif round is None:
             # For Q-Bot, current round is the number of facts present,
             # which is same as the number of answers observed
             round = len(self.answerEmbeds)
@@ -281,8 +375,8 @@ class Encoder(nn.Module):
             dialogIdx = len(self.dialogHiddens)
             self.embedDialog(dialogIdx)
 
-        # Latest dialogRNN hidden state
-        dialogHidden = self.dialogHiddens[-1][0]
+        # dialogRNN hidden state of the current round
+        dialogHidden = self.dialogHiddens[round][0]
 
         '''
         Return hidden (H_link) and cell (C_link) states as per the following rule:
@@ -300,14 +394,30 @@ class Encoder(nn.Module):
                 Layer 1 : DialogRNN hidden state (dialogRNN)
         '''
         if self.isAnswerer:
-            quesRNNstates = self.questionRNNStates[-1][1]  # Latest quesRNN states
+            quesRNNstates = self.questionRNNStates[round][1]  # Current round
             C_link = quesRNNstates[1]
             H_link = quesRNNstates[0][:-1]
             H_link = torch.cat([H_link, dialogHidden.unsqueeze(0)], 0)
         else:
-            factRNNstates = self.factEmbeds[-1][1]  # Latest factRNN states
+            factRNNstates = self.factEmbeds[round][1]  # Current round
             C_link = factRNNstates[1]
             H_link = factRNNstates[0][:-1]
             H_link = torch.cat([H_link, dialogHidden.unsqueeze(0)], 0)
 
         return H_link, C_link
+
+    def forwardDialog(self, numRounds):
+        '''
+        Encoder states of rounds 0 to numRounds - 1, with inputs of all
+        rounds encoded in bulk (see embedBulk).
+
+        Returns:
+            A tuple of tensors (H, C) each of shape (numLayers,
+            numRounds * batchSize, rnnHiddenSize), stacked round by round
+            along the batch dimension
+        '''
+        self.embedBulk(numRounds - 1)
+        states = [self.forward(round) for round in range(numRounds)]
+        H_link = torch.cat([H for H, _ in states], 1)
+        C_link = torch.cat([C for _, C in states], 1)
+        return H_link, C_link
@@ -77,19 +77,48 @@ class Questioner(Agent):
 
         self.encoder.observe(round, ques=ques, **kwargs)
 
-    def forward(self):
+    def forward(self, returnNll=False):
         '''
         Forward pass the last observed question to compute its log
-        likelihood under the current decoder RNN state.
+        likelihood under the current decoder RNN state. If returnNll is
+        True, the NLL loss of the question is returned instead of its
+        log-probabilities (see Decoder.forwardNll).
         '''
         encStates = self.encoder()
         if len(self.questions) == 0:
             raise Exception('Must provide question if not sampling one.')
         decIn = self.questions[-1]
 
+        if returnNll:
+            return self.decoder.forwardNll(encStates, decIn)
         logProbs = self.decoder(encStates, inputSeq=decIn)
         return logProbs
 
+    def forwardDialog(self, returnNll=False):
+        '''
+        Forward pass all observed questions at once (teacher forcing over
+        the whole dialog). The decoder RNN runs once over batch x rounds,
+        each round starting from the encoder state of that round.
+
+        Output:
+            A list with a (batchSize, length, vocabSize) sized tensor of
+            log-probabilities per round, as forward() returns when called
+            after each question is observed.
+            If returnNll is True, a list of per round NLL losses instead
+        '''
+        numRounds = len(self.questions)
+        encStates = self.encoder.forwardDialog(numRounds)
+        decIn = utils.padAndStack(self.questions)
+        if returnNll:
+            scores = self.decoder.forwardNll(
+                encStates, decIn, returnScores=True)
+            return [-score.sum() / score.size(0)
+                    for score in scores.split(self.encoder.batchSize)]
+        logProbs = self.decoder(encStates, inputSeq=decIn)
+        logProbs = logProbs.split(self.encoder.batchSize)
+        return [logProb[:, :ques.size(1)]
+                for logProb, ques in zip(logProbs, self.questions)]
+
     def forwardDecode(self, inference='sample', beamSize=1, maxSeqLen=20):
         '''
         Decode a sequence (question) using either sampling or greedy inference.
@@ -113,13 +142,14 @@ class Questioner(Agent):
             beamSize=beamSize)
         return questions, quesLens
 
-    def predictImage(self):
+    def predictImage(self, round=None):
         '''
         Predict/guess an fc7 vector given the current conversation history. This can
         be called at round 0 after the caption is observed, and at end of every round
-        (after a response from A-Bot is observed).
+        (after a response from A-Bot is observed). Pass 'round' to predict from the
+        history of an earlier round, e.g. after observing the whole dialog.
         '''
-        encState = self.encoder()
+        encState = self.encoder(round)
         # h, c from lstm
         h, c = encState
         return self.featureNet(self.featureNetInputDropout(h[-1]))